@@ -0,0 +1,406 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import secrets
+import shutil
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Fields of the yt-dlp info dict the bot actually reads
+INFO_FIELDS = (
+    "id", "extractor_key", "webpage_url", "title", "duration", "uploader",
+    "view_count", "like_count", "is_live", "width", "height",
+)
+FORMAT_FIELDS = (
+    "format_id", "format_note", "ext", "vcodec", "acodec", "width", "height",
+    "fps", "tbr", "vbr", "abr", "asr", "filesize", "filesize_approx", "protocol",
+)
+MAX_THUMBNAILS = 3
+
+
+@lru_cache(maxsize=1)
+def _extractor_classes() -> List:
+    from yt_dlp.extractor import gen_extractor_classes
+    return [ie for ie in gen_extractor_classes() if ie.ie_key() != "Generic"]
+
+
+@lru_cache(maxsize=4096)
+def canonical_video_key(url: str) -> Optional[str]:
+    """Return "<extractor>:<video id>" for url without touching the network.
+
+    youtu.be, youtube.com/watch and /shorts links for the same video all map
+    to the same key. Returns None when no extractor recognises the URL.
+    """
+    for ie in _extractor_classes():
+        if ie.suitable(url):
+            video_id = ie.get_temp_id(url)
+            return f"{ie.ie_key()}:{video_id}" if video_id else None
+    return None
+
+
+def trim_info(info: Dict) -> Dict:
+    """Strip a yt-dlp info dict down to the fields the bot uses"""
+    trimmed = {k: info[k] for k in INFO_FIELDS if info.get(k) is not None}
+    trimmed["formats"] = [
+        {k: f[k] for k in FORMAT_FIELDS if f.get(k) is not None}
+        for f in info.get("formats") or []
+    ]
+    thumbnails = [t for t in info.get("thumbnails") or [] if t.get("url")]
+    trimmed["thumbnails"] = [
+        {k: t[k] for k in ("url", "width", "height") if t.get(k) is not None}
+        for t in thumbnails[-MAX_THUMBNAILS:]
+    ]
+    return trimmed
+
+
+class MetadataCache:
+    """In-memory LRU in front of an SQLite store of trimmed info dicts.
+
+    Memory hits are answered on the event loop; SQLite reads and writes run
+    on a dedicated thread so disk I/O never blocks it.
+    """
+
+    def __init__(self, path: str, ttl: float = 6 * 3600, memory_entries: int = 512, disk_entries: int = 20000):
+        self.ttl = ttl
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._inserts = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="metadata-cache")
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS metadata ("
+            "key TEXT PRIMARY KEY, stored_at REAL NOT NULL, data TEXT NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS metadata_stored_at ON metadata (stored_at)")
+        self._db.commit()
+
+    async def get(self, key: Optional[str]) -> Optional[Dict]:
+        """Return the cached info for key, or None if missing or expired"""
+        if not key:
+            return None
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and time.time() - entry[0] < self.ttl:
+                self._memory.move_to_end(key)
+                return entry[1]
+        return await self._run(self._load, key)
+
+    async def put(self, key: Optional[str], info: Dict):
+        """Store an already trimmed info dict under key"""
+        if not key:
+            return
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, info)
+        await self._run(self._store, key, now, info)
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _load(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT stored_at, data FROM metadata WHERE key = ?", (key,)
+            ).fetchone()
+            if row and time.time() - row[0] < self.ttl:
+                info = json.loads(row[1])
+                self._remember(key, row[0], info)
+                return info
+            return None
+
+    def _store(self, key: str, now: float, info: Dict):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO metadata (key, stored_at, data) VALUES (?, ?, ?)",
+                (key, now, json.dumps(info, separators=(",", ":"))),
+            )
+            self._db.commit()
+            self._inserts += 1
+            if self._inserts % 100 == 0:
+                self._evict(now)
+
+    def _remember(self, key: str, stored_at: float, info: Dict):
+        self._memory[key] = (stored_at, info)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict(self, now: float):
+        """Drop expired rows and trim the store back under its size cap"""
+        self._db.execute("DELETE FROM metadata WHERE stored_at < ?", (now - self.ttl,))
+        self._db.execute(
+            "DELETE FROM metadata WHERE key IN ("
+            "SELECT key FROM metadata ORDER BY stored_at DESC LIMIT -1 OFFSET ?)",
+            (self.disk_entries,),
+        )
+        self._db.commit()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            self._db.close()
+
+
+class FileIdCache:
+    """Persistent (video key, variant) -> Telegram file_id index.
+
+    variant is the callback selection that produced the upload (for example
+    "format_18" or "audio_128"), so each quality is cached separately.
+    Queries run on a dedicated thread so disk I/O never blocks the event loop.
+    """
+
+    def __init__(self, path: str, max_entries: int = 100000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._inserts = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="file-id-cache")
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS file_ids ("
+            "video_key TEXT NOT NULL, variant TEXT NOT NULL, kind TEXT NOT NULL, "
+            "file_id TEXT NOT NULL, stored_at REAL NOT NULL, "
+            "PRIMARY KEY (video_key, variant))"
+        )
+        self._db.commit()
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def get(self, video_key: Optional[str], variant: str) -> Optional[tuple]:
+        """Return (kind, file_id) for a previous upload, or None"""
+        if not video_key:
+            return None
+        return await self._run(self._get, video_key, variant)
+
+    async def put(self, video_key: Optional[str], variant: str, kind: str, file_id: str):
+        if not video_key:
+            return
+        await self._run(self._put, video_key, variant, kind, file_id)
+
+    async def invalidate(self, video_key: Optional[str], variant: str):
+        """Forget a file_id that Telegram no longer accepts"""
+        if not video_key:
+            return
+        await self._run(self._invalidate, video_key, variant)
+
+    def _get(self, video_key: str, variant: str) -> Optional[tuple]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT kind, file_id FROM file_ids WHERE video_key = ? AND variant = ?",
+                (video_key, variant),
+            ).fetchone()
+            return (row[0], row[1]) if row else None
+
+    def _put(self, video_key: str, variant: str, kind: str, file_id: str):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO file_ids (video_key, variant, kind, file_id, stored_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (video_key, variant, kind, file_id, time.time()),
+            )
+            self._inserts += 1
+            if self._inserts % 100 == 0:
+                self._db.execute(
+                    "DELETE FROM file_ids WHERE rowid IN ("
+                    "SELECT rowid FROM file_ids ORDER BY stored_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+            self._db.commit()
+
+    def _invalidate(self, video_key: str, variant: str):
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM file_ids WHERE video_key = ? AND variant = ?", (video_key, variant)
+            )
+            self._db.commit()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            self._db.close()
+
+
+class MediaCache:
+    """Directory of finished downloads under a byte budget, evicted least recently used first.
+
+    Entries are keyed by a string naming the video, format and post-processing
+    recipe. Files enter the cache with a rename, so a reader never sees a
+    partial file, and files being uploaded are pinned by a reference count
+    until released. Once the total passes max_bytes, unpinned entries are
+    evicted until it drops to low_watermark * max_bytes.
+    """
+
+    def __init__(self, path: str, max_bytes: int, low_watermark: float = 0.8):
+        self.path = path
+        # Downloads write below here so adding them to the cache is a same-filesystem rename
+        self.incoming_dir = os.path.join(path, "incoming")
+        self.max_bytes = max_bytes
+        self.low_watermark = low_watermark
+        self.total_bytes = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # name -> (filename, size)
+        self._refs: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+        os.makedirs(self.incoming_dir, exist_ok=True)
+        self._load()
+
+    @staticmethod
+    def _name(key: str) -> str:
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def _load(self):
+        """Rebuild the index from the directory, oldest use first"""
+        files = []
+        for entry in os.scandir(self.path):
+            if not entry.is_file():
+                continue
+            if ".partial-" in entry.name:
+                os.remove(entry.path)
+                continue
+            stat = entry.stat()
+            files.append((stat.st_mtime, entry.name, stat.st_size))
+        with self._lock:
+            for _, filename, size in sorted(files):
+                self._entries[filename.split(".", 1)[0]] = (filename, size)
+                self.total_bytes += size
+            self._evict()
+
+    def acquire(self, key: Optional[str]) -> Optional[str]:
+        """Return the cached file for key, pinned until release(), or None"""
+        if not key:
+            return None
+        name = self._name(key)
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return None
+            self._entries.move_to_end(name)
+            self._refs[name] = self._refs.get(name, 0) + 1
+        path = os.path.join(self.path, entry[0])
+        try:
+            # Keeps the LRU order across restarts
+            os.utime(path)
+        except OSError:
+            pass
+        return path
+
+    def contains(self, key: Optional[str]) -> bool:
+        if not key:
+            return False
+        with self._lock:
+            return self._name(key) in self._entries
+
+    def put(self, key: Optional[str], src: str) -> str:
+        """Move a finished file into the cache and return its cached path, pinned until release().
+
+        Returns src unchanged when the file cannot be cached, in which case
+        the caller still owns it.
+        """
+        if not key or not self.max_bytes:
+            return src
+        size = os.path.getsize(src)
+        if size > self.max_bytes * self.low_watermark:
+            return src
+        name = self._name(key)
+        filename = name + os.path.splitext(src)[1]
+        final = os.path.join(self.path, filename)
+        partial = f"{final}.partial-{secrets.token_hex(4)}"
+        try:
+            try:
+                os.replace(src, final)
+            except OSError:
+                # src is on another filesystem: copy beside the final name, then rename
+                shutil.copyfile(src, partial)
+                os.replace(partial, final)
+        except OSError as e:
+            logger.error(f"Could not add {src} to the media cache: {e}")
+            if os.path.exists(partial):
+                os.remove(partial)
+            return src
+
+        with self._lock:
+            old = self._entries.pop(name, None)
+            if old:
+                self.total_bytes -= old[1]
+                if old[0] != filename:
+                    self._remove(old[0])
+            self._entries[name] = (filename, size)
+            self.total_bytes += size
+            self._refs[name] = self._refs.get(name, 0) + 1
+            self._evict()
+        return final
+
+    def release(self, path: Optional[str]):
+        """Unpin a path returned by acquire() or put(); other paths are ignored"""
+        if not path:
+            return
+        name = os.path.basename(path).split(".", 1)[0]
+        with self._lock:
+            refs = self._refs.get(name)
+            if refs is None:
+                return
+            if refs > 1:
+                self._refs[name] = refs - 1
+            else:
+                del self._refs[name]
+            # Pinned entries may have held the cache over budget
+            self._evict()
+
+    def _evict(self):
+        if self.total_bytes <= self.max_bytes:
+            return
+        target = self.max_bytes * self.low_watermark
+        for name in list(self._entries):
+            if self.total_bytes <= target:
+                break
+            if self._refs.get(name):
+                continue
+            filename, size = self._entries.pop(name)
+            self._remove(filename)
+            self.total_bytes -= size
+            self.evictions += 1
+
+    def trim(self, nbytes: int) -> int:
+        """Evict unpinned entries, oldest use first, until nbytes are freed; returns bytes freed"""
+        freed = 0
+        with self._lock:
+            for name in list(self._entries):
+                if freed >= nbytes:
+                    break
+                if self._refs.get(name):
+                    continue
+                filename, size = self._entries.pop(name)
+                self._remove(filename)
+                self.total_bytes -= size
+                self.evictions += 1
+                freed += size
+        return freed
+
+    def _remove(self, filename: str):
+        try:
+            os.remove(os.path.join(self.path, filename))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Could not evict {filename} from the media cache: {e}")
+
+    def __len__(self) -> int:
+        return len(self._entries)
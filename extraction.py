@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, Hashable, Set
+
+import yt_dlp
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_MISSING = object()
+
+
+@contextmanager
+def pooled_ydl(opts: Dict, **overrides):
+    """Borrow the calling thread's YoutubeDL for opts.
+
+    Each worker thread keeps one instance per options dict, so extractor
+    state, parsed cookies and keep-alive HTTP connections are reused across
+    lookups instead of being rebuilt every time. opts must be a long-lived
+    dict (instances are keyed by its identity). overrides are per-call
+    params such as "format" or "playlist_items" that yt-dlp reads while
+    processing, and are restored afterwards.
+    """
+    instances = _local.__dict__.setdefault("instances", {})
+    ydl = instances.get(id(opts))
+    if ydl is None:
+        ydl = instances[id(opts)] = yt_dlp.YoutubeDL(opts)
+    saved = {key: ydl.params.get(key, _MISSING) for key in overrides}
+    selector = ydl.format_selector
+    ydl.params.update(overrides)
+    if "format" in overrides:
+        # YoutubeDL compiles "format" once in __init__, so the param alone would be ignored
+        ydl.format_selector = ydl.build_format_selector(overrides["format"])
+    try:
+        yield ydl
+    finally:
+        ydl.format_selector = selector
+        for key, value in saved.items():
+            if value is _MISSING:
+                ydl.params.pop(key, None)
+            else:
+                ydl.params[key] = value
+
+
+class ExtractionQueueFull(Exception):
+    """Raised when the extraction pool has no room for another request"""
+
+
+class ExtractionCancelled(Exception):
+    """Raised when a pending extraction was cancelled by the user"""
+
+
+class ExtractionPool:
+    """Bounded thread pool for blocking yt-dlp metadata lookups.
+
+    Requests are keyed (usually by chat and message id) so that the
+    "❌ Cancel" button can abort the matching lookup. A lookup that has not
+    started yet is dropped from the queue; one that is already running is
+    abandoned and its result discarded once the worker thread returns.
+    """
+
+    def __init__(self, max_workers: int = 4, max_queue: int = 32, timeout: float = 60):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="extract")
+        self._lock = threading.Lock()
+        self._outstanding = 0
+        self._jobs: Dict[Hashable, asyncio.Future] = {}
+        self._cancelled: Set[Hashable] = set()
+
+    @property
+    def outstanding(self) -> int:
+        """Number of lookups running or waiting for a worker"""
+        with self._lock:
+            return self._outstanding
+
+    def _release(self, _future):
+        with self._lock:
+            self._outstanding -= 1
+
+    async def run(self, key: Hashable, fn: Callable, *args):
+        """Run fn(*args) on the pool and wait for its result"""
+        with self._lock:
+            if self._outstanding >= self.max_workers + self.max_queue:
+                raise ExtractionQueueFull("Too many lookups in progress, please try again shortly")
+            self._outstanding += 1
+        try:
+            concurrent_future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._release(None)
+            raise
+        # The slot is held until the worker actually finishes, even if the
+        # caller gave up on it, so abandoned lookups still count against the limit.
+        concurrent_future.add_done_callback(self._release)
+
+        future = asyncio.wrap_future(concurrent_future)
+        self._jobs[key] = future
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.CancelledError:
+            if key in self._cancelled:
+                raise ExtractionCancelled("Lookup cancelled") from None
+            raise
+        finally:
+            self._jobs.pop(key, None)
+            self._cancelled.discard(key)
+
+    def cancel(self, key: Hashable) -> bool:
+        """Cancel the lookup registered under key, if any"""
+        future = self._jobs.get(key)
+        if future is None or future.done():
+            return False
+        self._cancelled.add(key)
+        future.cancel()
+        logger.info(f"Cancelled metadata lookup {key}")
+        return True
+
+    def shutdown(self):
+        """Stop accepting work and drop queued lookups"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,240 @@
+import logging
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Headroom for container overhead when merging separate video and audio
+MERGE_OVERHEAD = 1.03
+
+
+class FileTooLarge(ValueError):
+    """Raised when a download cannot fit under the upload size limit"""
+
+
+def has_video(f: Dict) -> bool:
+    return f.get("vcodec") not in (None, "none")
+
+
+def has_audio(f: Dict) -> bool:
+    return f.get("acodec") not in (None, "none")
+
+
+def estimate_size(f: Dict, duration: Optional[float]) -> Optional[int]:
+    """Best guess of a format's size in bytes, or None if nothing is known"""
+    size = f.get("filesize") or f.get("filesize_approx")
+    if size:
+        return int(size)
+    if f.get("tbr") and duration:
+        # tbr is in kbit/s
+        return int(f["tbr"] * 1000 / 8 * duration)
+    return None
+
+
+def estimate_audio_size(bitrate_kbps: int, duration: Optional[float]) -> Optional[int]:
+    """Size of an audio track encoded at bitrate_kbps"""
+    if not duration:
+        return None
+    return int(bitrate_kbps * 1000 / 8 * duration)
+
+
+def fits(size: Optional[int], max_size: int) -> bool:
+    """Unknown sizes are given the benefit of the doubt"""
+    return size is None or size <= max_size
+
+
+def selection_size(info: Dict, format_spec: str) -> Optional[int]:
+    """Estimated size of a "<id>" or "<video id>+<audio id>" selection"""
+    duration = info.get("duration")
+    by_id = {f.get("format_id"): f for f in info.get("formats") or []}
+    total = 0
+    for format_id in format_spec.split("+"):
+        f = by_id.get(format_id)
+        size = estimate_size(f, duration) if f else None
+        if size is None:
+            return None
+        total += size
+    if "+" in format_spec:
+        total = int(total * MERGE_OVERHEAD)
+    return total
+
+
+def chosen_size(info: Dict) -> Optional[int]:
+    """Estimated size of the format(s) yt-dlp selected in a download's info dict"""
+    duration = info.get("duration")
+    formats = info.get("requested_formats") or [info]
+    sizes = [estimate_size(f, duration) for f in formats]
+    if None in sizes:
+        return None
+    total = sum(sizes)
+    if len(formats) > 1:
+        total = int(total * MERGE_OVERHEAD)
+    return total
+
+
+def capped_format_spec(max_height: int, max_size: int) -> str:
+    """yt-dlp format spec for the best format up to max_height whose reported size fits max_size.
+
+    Formats that report no size pass the filters ("<?") and are left to
+    yt-dlp's max_filesize. The last, unfiltered fallback lets an item with
+    nothing small enough be reported as too large rather than unavailable.
+    """
+    video_size = int(max_size / MERGE_OVERHEAD * 0.85)
+    audio_size = int(max_size / MERGE_OVERHEAD) - video_size
+
+    def under(size: int) -> str:
+        return f"[filesize<?{size}][filesize_approx<?{size}]"
+
+    return (
+        f"bv*[height<={max_height}]{under(video_size)}+ba{under(audio_size)}"
+        f"/b[height<={max_height}]{under(max_size)}"
+        f"/b{under(max_size)}/b"
+    )
+
+
+def _quality(f: Dict) -> Tuple:
+    return (f.get("height") or 0, f.get("tbr") or 0)
+
+
+def best_audio_format(info: Dict) -> Optional[Dict]:
+    """Highest bitrate audio-only format, preferring m4a so it merges into mp4"""
+    audio = [f for f in info.get("formats") or [] if has_audio(f) and not has_video(f)]
+    if not audio:
+        return None
+    return max(audio, key=lambda f: (f.get("ext") == "m4a", f.get("abr") or f.get("tbr") or 0))
+
+
+def best_under_cap(info: Dict, max_size: int) -> Optional[Tuple[str, Dict, int]]:
+    """Pick the best selection whose estimated size fits max_size.
+
+    Returns (format spec, video format, estimated size) or None when no
+    format has a usable size estimate under the cap.
+    """
+    duration = info.get("duration")
+    formats = info.get("formats") or []
+    candidates: List[Tuple[str, Dict, int]] = []
+
+    for f in formats:
+        if has_video(f) and has_audio(f):
+            size = estimate_size(f, duration)
+            if size is not None and size <= max_size:
+                candidates.append((f["format_id"], f, size))
+
+    audio = best_audio_format(info)
+    audio_size = estimate_size(audio, duration) if audio else None
+    if audio_size is not None:
+        for f in formats:
+            if not has_video(f) or has_audio(f):
+                continue
+            video_size = estimate_size(f, duration)
+            if video_size is None:
+                continue
+            size = int((video_size + audio_size) * MERGE_OVERHEAD)
+            if size <= max_size:
+                candidates.append((f"{f['format_id']}+{audio['format_id']}", f, size))
+
+    if not candidates:
+        return None
+    return max(candidates, key=lambda c: _quality(c[1]))
+
+
+def streamable_format(info: Dict, format_spec: str) -> Optional[Dict]:
+    """The format behind format_spec if it can go to Telegram exactly as served.
+
+    That means one muxed mp4 fetched over plain HTTP(S): no merge, no
+    remux and no fragments, so no post-processing step needs a local file.
+    """
+    if "+" in format_spec or "/" in format_spec:
+        return None
+    f = next((f for f in info.get("formats") or [] if f.get("format_id") == format_spec), None)
+    if not f or not has_video(f) or not has_audio(f):
+        return None
+    if f.get("protocol") not in ("http", "https") or f.get("ext") != "mp4":
+        return None
+    return f
+
+
+# Standard MP3 bitrates in kbps
+MP3_BITRATES = (128, 192, 256, 320)
+
+
+def mp3_bitrate_cap(audio_format: Optional[Dict]) -> int:
+    """Highest standard MP3 bitrate that does not exceed the source's bitrate.
+
+    Encoding above the source bitrate only adds bytes, not quality.
+    """
+    abr = (audio_format or {}).get("abr")
+    if not abr:
+        return MP3_BITRATES[-1]
+    return max([b for b in MP3_BITRATES if b <= abr] or [MP3_BITRATES[0]])
+
+
+# Resolutions offered on the quality keyboard, by the short side of the frame
+LADDER_HEIGHTS = (1080, 720, 480, 360)
+
+
+def short_side(f: Dict) -> int:
+    """Nominal resolution, so vertical 1080x1920 videos count as 1080p"""
+    sides = [s for s in (f.get("width"), f.get("height")) if s]
+    return min(sides) if sides else 0
+
+
+def remuxable(f: Dict) -> bool:
+    """H.264 video and AAC audio can be merged into mp4 without re-encoding"""
+    vcodec = f.get("vcodec") or ""
+    acodec = f.get("acodec") or ""
+    video_ok = not has_video(f) or vcodec.startswith("avc1")
+    audio_ok = not has_audio(f) or acodec.startswith("mp4a")
+    return video_ok and audio_ok
+
+
+def build_format_ladder(info: Dict, max_size: int, heights=LADDER_HEIGHTS) -> List[Dict]:
+    """Compose one option per ladder rung from DASH video + audio pairs.
+
+    Each rung picks the preferred video stream for that resolution, pairing
+    video-only streams with the best audio-only stream, and falls back to a
+    progressive format when no pair exists. Rungs whose estimated size is
+    known to exceed max_size are left out. Returns dicts with "spec",
+    "height", "ext", "size" and "remux" keys, best quality first.
+    """
+    duration = info.get("duration")
+    audio = best_audio_format(info)
+    audio_size = estimate_size(audio, duration) if audio else None
+
+    buckets: Dict[int, List[Dict]] = {}
+    for f in info.get("formats") or []:
+        if not has_video(f) or not f.get("format_id"):
+            continue
+        if not has_audio(f) and audio is None:
+            continue
+        side = short_side(f)
+        rung = next((h for h in heights if side >= h), None)
+        if rung is None or side > heights[0] * 1.5:
+            continue
+        buckets.setdefault(rung, []).append(f)
+
+    ladder = []
+    for rung in heights:
+        options = []
+        for f in buckets.get(rung, []):
+            if has_audio(f):
+                spec = f["format_id"]
+                size = estimate_size(f, duration)
+                remux = remuxable(f)
+            else:
+                spec = f"{f['format_id']}+{audio['format_id']}"
+                video_size = estimate_size(f, duration)
+                size = None
+                if video_size is not None and audio_size is not None:
+                    size = int((video_size + audio_size) * MERGE_OVERHEAD)
+                remux = remuxable(f) and remuxable(audio)
+            if not fits(size, max_size):
+                continue
+            options.append({"spec": spec, "height": rung, "ext": "mp4" if remux else f.get("ext", "?"),
+                            "size": size, "remux": remux, "tbr": f.get("tbr") or 0,
+                            "split": not has_audio(f)})
+        if options:
+            # Prefer streams that merge without re-encoding, then DASH pairs
+            # (usually better quality per byte), then the highest bitrate
+            best = max(options, key=lambda o: (o["remux"], o["split"], o["tbr"]))
+            ladder.append({k: best[k] for k in ("spec", "height", "ext", "size", "remux")})
+    return ladder
@@ -1,21 +1,222 @@
-from http.server import SimpleHTTPRequestHandler, HTTPServer
+import asyncio
+import hmac
+import json
+import logging
+import threading
+import time
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+import metrics
+
+logger = logging.getLogger(__name__)
 
 PORT = 10000  # Same as Koyeb's health check port
+MAX_BODY_SIZE = 1024 * 1024  # Telegram updates are far smaller than this
+REQUEST_TIMEOUT = 30  # seconds to wait for a client to send a request
+
+# Probe state, written by the bot's heartbeat task and read by either server
+_state_lock = threading.Lock()
+_last_heartbeat: Optional[float] = None
+_load: Dict = {}
+liveness_max_age = 30.0  # seconds without a heartbeat before /livez fails
+readiness_max: Dict[str, float] = {}  # load key -> highest value still ready
+readiness_min: Dict[str, float] = {}  # load key -> lowest value still ready
+
+def configure_probes(max_heartbeat_age: float, max_load: Dict[str, float], min_load: Dict[str, float]):
+    """Set the liveness age limit and readiness thresholds"""
+    global liveness_max_age
+    liveness_max_age = max_heartbeat_age
+    readiness_max.update(max_load)
+    readiness_min.update(min_load)
+
+def heartbeat(load: Optional[Dict] = None):
+    """Record that the event loop is responsive, with a snapshot of its load"""
+    global _last_heartbeat, _load
+    with _state_lock:
+        _last_heartbeat = time.monotonic()
+        if load is not None:
+            _load = dict(load)
+
+def check_liveness() -> Tuple[bool, Dict]:
+    """Live while the event loop keeps sending heartbeats"""
+    with _state_lock:
+        last = _last_heartbeat
+    if last is None:
+        # Still starting up; not dead yet
+        return True, {"heartbeat_age": None}
+    age = time.monotonic() - last
+    return age <= liveness_max_age, {"heartbeat_age": round(age, 3)}
+
+def check_readiness() -> Tuple[bool, Dict]:
+    """Ready while live, started and every load figure is within its threshold"""
+    live, details = check_liveness()
+    with _state_lock:
+        load = dict(_load)
+    details.update(load)
+    failing = [k for k, limit in readiness_max.items() if load.get(k, 0) > limit]
+    failing += [k for k, limit in readiness_min.items() if k in load and load[k] < limit]
+    if details["heartbeat_age"] is None:
+        failing.append("starting")
+    if not live:
+        failing.append("heartbeat_age")
+    details["failing"] = failing
+    return not failing, details
+
+def _probe_response(ok: bool, details: Dict) -> Tuple[int, str, bytes]:
+    body = json.dumps({"status": "ok" if ok else "fail", **details}).encode()
+    return (200 if ok else 503), "application/json", body
+
+def route_health(path: str) -> Tuple[int, str, bytes]:
+    """Answer a health route with (status, content type, body)"""
+    if path == "/":
+        return 200, "text/plain", b"OK"
+    if path == "/livez":
+        return _probe_response(*check_liveness())
+    if path == "/readyz":
+        return _probe_response(*check_readiness())
+    if path == "/metrics":
+        return 200, "text/plain; version=0.0.4", metrics.render().encode()
+    return 404, "text/plain", b"Not Found"
 
 class HealthCheckHandler(SimpleHTTPRequestHandler):
     def do_GET(self):
-        if self.path == "/":
-            self.send_response(200)
-            self.end_headers()
-            self.wfile.write(b"OK")
-        else:
-            self.send_response(404)
-            self.end_headers()
+        status, content_type, body = route_health(self.path.split("?", 1)[0])
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Probes hit these routes every few seconds; keep them out of the logs
+        pass
 
 def run_health_server():
+    """Serve health routes from threads, independent of the bot's event loop"""
     server_address = ("0.0.0.0", PORT)
-    httpd = HTTPServer(server_address, HealthCheckHandler)
+    httpd = ThreadingHTTPServer(server_address, HealthCheckHandler)
+    httpd.daemon_threads = True
     httpd.serve_forever()
 
+class WebhookServer:
+    """Minimal asyncio HTTP/1.1 server for the Telegram webhook and health routes.
+
+    POST requests to webhook_path must carry the secret token Telegram was
+    given in setWebhook; their JSON body is handed to on_update. GET
+    requests are answered by route_health. Because this server shares the
+    bot's event loop, a wedged loop makes /livez time out, which probes
+    treat as a failure just like a 503.
+    """
+
+    def __init__(
+        self,
+        webhook_path: str,
+        on_update: Callable[[dict], Awaitable],
+        secret_token: Optional[str] = None,
+        host: str = "0.0.0.0",
+        port: int = PORT,
+    ):
+        self.webhook_path = webhook_path
+        self.on_update = on_update
+        self.secret_token = secret_token
+        self.host = host
+        self.port = port
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        logger.info(f"Webhook server listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # Telegram keeps connections alive, so serve requests until the client hangs up
+            while True:
+                request = await asyncio.wait_for(self._read_request(reader), REQUEST_TIMEOUT)
+                if request is None:
+                    break
+                method, path, version, headers, body = request
+                status, content_type, payload = await self._route(method, path, headers, body)
+                keep_alive = self._keep_alive(version, headers)
+                self._write_response(writer, status, content_type, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except ValueError as e:
+            logger.warning(f"Bad request to webhook server: {e}")
+            self._write_response(writer, 400, "text/plain", b"Bad Request", False)
+        except Exception as e:
+            logger.error(f"Webhook server error: {e}", exc_info=True)
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        parts = request_line.decode("latin-1").split()
+        if len(parts) != 3:
+            raise ValueError(f"Malformed request line {request_line!r}")
+        method, path, version = parts
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        length = int(headers.get("content-length", "0"))
+        if length > MAX_BODY_SIZE:
+            raise ValueError(f"Request body too large ({length} bytes)")
+        body = await reader.readexactly(length) if length else b""
+        return method.upper(), path.split("?", 1)[0], version.upper(), headers, body
+
+    @staticmethod
+    def _keep_alive(version: str, headers: dict) -> bool:
+        """HTTP/1.1 connections persist unless closed; HTTP/1.0 ones only on request"""
+        connection = headers.get("connection", "").lower()
+        if version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+    async def _route(self, method: str, path: str, headers: dict, body: bytes) -> Tuple[int, str, bytes]:
+        if path == self.webhook_path:
+            if method != "POST":
+                return 405, "text/plain", b"Method Not Allowed"
+            token = headers.get("x-telegram-bot-api-secret-token", "")
+            if self.secret_token and not hmac.compare_digest(token.encode("latin-1"), self.secret_token.encode("latin-1")):
+                logger.warning("Rejected webhook call with a bad secret token")
+                return 403, "text/plain", b"Forbidden"
+            try:
+                update = json.loads(body)
+            except ValueError:
+                return 400, "text/plain", b"Bad Request"
+            await self.on_update(update)
+            return 200, "text/plain", b"OK"
+        if method == "GET":
+            return route_health(path)
+        return 405, "text/plain", b"Method Not Allowed"
+
+    @staticmethod
+    def _write_response(writer, status: int, content_type: str, body: bytes, keep_alive: bool):
+        reason = HTTPStatus(status).phrase
+        head = (
+            f"HTTP/1.1 {status} {reason}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + body)
+
 if __name__ == "__main__":
     run_health_server()
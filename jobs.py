@@ -0,0 +1,289 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from typing import Awaitable, Callable, Deque, Dict, Hashable, List, Optional, Tuple
+
+from metrics import POSTPROCESS_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# The download slot held by the current task, so a PostprocessGate can hand it back
+_current_slot: "ContextVar[Optional[_Ticket]]" = ContextVar("download_slot", default=None)
+
+# A message that shows progress for a job
+ProgressTarget = namedtuple("ProgressTarget", ["chat_id", "message_id", "use_caption"])
+
+
+class FlightFailed(Exception):
+    """Raised to followers when the download they joined did not finish"""
+
+
+class Flight:
+    """One running download shared by every chat that asked for it"""
+
+    def __init__(self, key: Hashable):
+        self.key = key
+        self.targets: List[ProgressTarget] = []
+        self._result = asyncio.get_running_loop().create_future()
+
+    def finish(self, result):
+        if not self._result.done():
+            self._result.set_result(result)
+
+    def fail(self, error: BaseException):
+        if self._result.done():
+            return
+        if isinstance(error, Exception):
+            self._result.set_exception(error)
+        else:
+            self._result.set_exception(FlightFailed("Download was interrupted"))
+        # Mark the exception as retrieved in case nobody joined this flight
+        self._result.exception()
+
+    async def wait(self):
+        """Wait for the leader's result without being able to cancel it"""
+        return await asyncio.shield(self._result)
+
+
+class SingleFlight:
+    """Coalesce concurrent identical downloads onto one running job.
+
+    The first caller for a key becomes the leader and does the work; later
+    callers join as followers, share its progress messages and receive its
+    result (the uploaded file_id) once it finishes.
+    """
+
+    def __init__(self):
+        self._flights: Dict[Hashable, Flight] = {}
+
+    def join(self, key: Hashable, target: ProgressTarget) -> Tuple[Flight, bool]:
+        """Attach target to the flight for key; returns (flight, is_leader)"""
+        flight = self._flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = self._flights[key] = Flight(key)
+        else:
+            logger.info(f"Joining in-flight download {key}")
+        flight.targets.append(target)
+        return flight, leader
+
+    def release(self, flight: Flight):
+        """Forget a finished flight so the next request starts fresh"""
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def __len__(self):
+        return len(self._flights)
+
+
+class _Ticket:
+    __slots__ = ("user_id", "future", "enqueued_at", "on_position", "position", "released")
+
+    def __init__(self, user_id: Hashable, on_position):
+        self.user_id = user_id
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        self.on_position = on_position
+        self.position = None
+        self.released = False
+
+
+@lru_cache(maxsize=1)
+def ffmpeg_postprocessors() -> frozenset:
+    """pp_key() of every yt-dlp postprocessor that runs ffmpeg, as reported to postprocessor hooks"""
+    from yt_dlp import postprocessor
+    from yt_dlp.postprocessor.ffmpeg import FFmpegPostProcessor
+    return frozenset(
+        cls.pp_key() for cls in vars(postprocessor).values()
+        if isinstance(cls, type) and issubclass(cls, FFmpegPostProcessor) and cls is not FFmpegPostProcessor
+    )
+
+
+class PostprocessGate:
+    """yt-dlp postprocessor hook that moves a job from the download stage to post-processing.
+
+    When the first ffmpeg step starts, the job waits for a post-processing
+    slot and then gives its download slot back, so the next download starts
+    while ffmpeg runs. A job still waiting for ffmpeg keeps its download
+    slot, which holds back new downloads while post-processing is saturated.
+    """
+
+    def __init__(self, scheduler: "DownloadScheduler"):
+        self.scheduler = scheduler
+        self.held = 0
+        self._started = 0.0
+        self._slot = _current_slot.get()
+        self._loop = asyncio.get_running_loop()
+        # Seconds spent in each ffmpeg postprocessor of this job
+        self.elapsed: Dict[str, float] = {}
+
+    def __call__(self, d):
+        if d.get("postprocessor") not in ffmpeg_postprocessors():
+            return
+        if d["status"] == "started":
+            self.scheduler.postprocess_slots.acquire()
+            self.held += 1
+            self.scheduler._postprocess_changed(1)
+            self._started = time.monotonic()
+            if self._slot and not self._slot.released:
+                self._loop.call_soon_threadsafe(self.scheduler._release_slot, self._slot)
+        elif d["status"] == "finished" and self.held:
+            elapsed = time.monotonic() - self._started
+            self.elapsed[d["postprocessor"]] = self.elapsed.get(d["postprocessor"], 0.0) + elapsed
+            POSTPROCESS_SECONDS.observe(elapsed, postprocessor=d["postprocessor"])
+            self.release()
+
+    def release(self):
+        """Give back a slot still held, e.g. after ffmpeg raised"""
+        while self.held:
+            self.held -= 1
+            self.scheduler.postprocess_slots.release()
+            self.scheduler._postprocess_changed(-1)
+
+
+class DownloadScheduler:
+    """Admission control for downloads.
+
+    At most max_downloads jobs download at once and each user has at most
+    one downloading job. Waiting jobs are served round-robin between users,
+    so one user queueing many links cannot starve everybody else. ffmpeg
+    post-processing is a separate stage of max_postprocess slots entered
+    through PostprocessGate hooks; the executor has threads for both stages.
+    """
+
+    def __init__(self, max_downloads: int = 3, max_postprocess: int = 2):
+        self.max_downloads = max_downloads
+        self.max_postprocess = max_postprocess
+        self.executor = ThreadPoolExecutor(max_workers=max_downloads + max_postprocess, thread_name_prefix="download")
+        self.postprocess_slots = threading.BoundedSemaphore(max_postprocess)
+        self._queues: "OrderedDict[Hashable, Deque[_Ticket]]" = OrderedDict()
+        self._running_users = set()
+        # Dispatch sequence number of each user's latest turn; users waiting or running keep theirs
+        self._last_turn: Dict[Hashable, int] = {}
+        self._turn = 0
+        self._active = 0
+        self._postprocessing = 0
+        self._pp_lock = threading.Lock()
+        self._wait_times: Deque[float] = deque(maxlen=200)
+        self._notifications = set()
+
+    @asynccontextmanager
+    async def slot(self, user_id: Hashable, on_position: Optional[Callable[[int], Awaitable]] = None):
+        """Wait for a download slot for user_id, reporting queue position changes"""
+        ticket = _Ticket(user_id, on_position)
+        self._queues.setdefault(user_id, deque()).append(ticket)
+        self._dispatch()
+        try:
+            await ticket.future
+        except BaseException:
+            if ticket.future.done() and not ticket.future.cancelled():
+                self._release(user_id)
+            else:
+                self._discard(ticket)
+            raise
+        context_token = _current_slot.set(ticket)
+        try:
+            yield
+        finally:
+            _current_slot.reset(context_token)
+            self._release_slot(ticket)
+
+    def new_postprocess_gate(self) -> PostprocessGate:
+        return PostprocessGate(self)
+
+    def _postprocess_changed(self, delta: int):
+        with self._pp_lock:
+            self._postprocessing += delta
+
+    def _discard(self, ticket: _Ticket):
+        queue = self._queues.get(ticket.user_id)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del self._queues[ticket.user_id]
+                if ticket.user_id not in self._running_users:
+                    self._last_turn.pop(ticket.user_id, None)
+        self._dispatch()
+
+    def _release_slot(self, ticket: _Ticket):
+        """Free a running job's download slot once, whichever stage gives it up first"""
+        if not ticket.released:
+            ticket.released = True
+            self._release(ticket.user_id)
+
+    def _release(self, user_id: Hashable):
+        self._active -= 1
+        self._running_users.discard(user_id)
+        if user_id not in self._queues:
+            self._last_turn.pop(user_id, None)
+        self._dispatch()
+
+    def _dispatch(self):
+        """Start waiting jobs while slots are free, then refresh queue positions"""
+        while self._active < self.max_downloads:
+            waiting = [u for u in self._rotation() if u not in self._running_users]
+            if not waiting:
+                break
+            user_id = waiting[0]
+            queue = self._queues[user_id]
+            ticket = queue.popleft()
+            if not queue:
+                del self._queues[user_id]
+            # The user goes to the back of the rotation now, even with nothing else queued,
+            # so a ticket they add later waits behind everyone already waiting
+            self._turn += 1
+            self._last_turn[user_id] = self._turn
+            self._active += 1
+            self._running_users.add(user_id)
+            self._wait_times.append(time.monotonic() - ticket.enqueued_at)
+            ticket.future.set_result(None)
+        self._notify_positions()
+
+    def _rotation(self) -> List[Hashable]:
+        """Users with waiting tickets, least recently served first; new users in arrival order"""
+        return sorted(self._queues, key=lambda u: self._last_turn.get(u, 0))
+
+    def _waiting_order(self) -> List[_Ticket]:
+        """Waiting tickets in the order they would be served"""
+        queues = [list(self._queues[u]) for u in self._rotation()]
+        order = []
+        for depth in range(max((len(q) for q in queues), default=0)):
+            order.extend(q[depth] for q in queues if depth < len(q))
+        return order
+
+    def _notify_positions(self):
+        for position, ticket in enumerate(self._waiting_order(), start=1):
+            if ticket.position == position or ticket.on_position is None:
+                continue
+            ticket.position = position
+            task = asyncio.get_running_loop().create_task(self._send_position(ticket, position))
+            self._notifications.add(task)
+            task.add_done_callback(self._notifications.discard)
+
+    @staticmethod
+    async def _send_position(ticket: _Ticket, position: int):
+        try:
+            await ticket.on_position(position)
+        except Exception as e:
+            logger.debug(f"Queue position update failed: {e}")
+
+    def stats(self) -> Dict:
+        """Queue length, active jobs and wait times for monitoring"""
+        now = time.monotonic()
+        waiting = [t for q in self._queues.values() for t in q]
+        return {
+            "queued": len(waiting),
+            "active_downloads": self._active,
+            "active_postprocessing": self._postprocessing,
+            "oldest_wait": max((now - t.enqueued_at for t in waiting), default=0.0),
+            "avg_wait": sum(self._wait_times) / len(self._wait_times) if self._wait_times else 0.0,
+        }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
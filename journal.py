@@ -0,0 +1,98 @@
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# A download that was running when the process stopped
+JournalEntry = namedtuple(
+    "JournalEntry",
+    ["job_id", "url", "media_type", "video_key", "chat_id", "message_id", "use_caption", "user_id", "temp_dir", "attempts"],
+)
+
+
+class JobJournal:
+    """SQLite record of running downloads, so the next start can resume them.
+
+    A job is added when it is accepted, before it waits for a download
+    slot, and removed once it finishes or fails; anything left in the
+    journal was cut short by a restart. temp_dir stays empty until the job
+    starts downloading.
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job_id TEXT PRIMARY KEY, url TEXT NOT NULL, media_type TEXT NOT NULL, video_key TEXT, "
+            "chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL, use_caption INTEGER NOT NULL, "
+            "user_id INTEGER NOT NULL, temp_dir TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+            "created_at REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def add(
+        self,
+        url: str,
+        media_type: str,
+        video_key: Optional[str],
+        chat_id: int,
+        message_id: int,
+        use_caption: bool,
+        user_id: int,
+        temp_dir: str = "",
+    ) -> str:
+        """Record an accepted job and return its id"""
+        job_id = secrets.token_hex(8)
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO jobs (job_id, url, media_type, video_key, chat_id, message_id, use_caption, "
+                "user_id, temp_dir, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, url, media_type, video_key, chat_id, message_id, int(use_caption), user_id, temp_dir, time.time()),
+            )
+            self._db.commit()
+        return job_id
+
+    def set_temp_dir(self, job_id: str, temp_dir: str):
+        """Record where a job that has started downloading keeps its partial files"""
+        with self._lock:
+            self._db.execute("UPDATE jobs SET temp_dir = ? WHERE job_id = ?", (temp_dir, job_id))
+            self._db.commit()
+
+    def remove(self, job_id: str):
+        with self._lock:
+            self._db.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+            self._db.commit()
+
+    def take_interrupted(self, max_attempts: int) -> Tuple[List[JournalEntry], List[JournalEntry]]:
+        """Jobs left by the previous process, as (to resume, given up).
+
+        Each start counts as one more resume attempt. Jobs past
+        max_attempts are removed and returned separately, so a download
+        that crashes the bot cannot make it crash on every start.
+        """
+        with self._lock:
+            self._db.execute("UPDATE jobs SET attempts = attempts + 1")
+            rows = self._db.execute(
+                "SELECT job_id, url, media_type, video_key, chat_id, message_id, use_caption, user_id, temp_dir, attempts "
+                "FROM jobs ORDER BY created_at"
+            ).fetchall()
+            self._db.execute("DELETE FROM jobs WHERE attempts > ?", (max_attempts,))
+            self._db.commit()
+        jobs = [JournalEntry(*row[:6], bool(row[6]), *row[7:]) for row in rows]
+        dropped = [job for job in jobs if job.attempts > max_attempts]
+        if dropped:
+            logger.warning(f"Gave up on {len(dropped)} interrupted downloads after {max_attempts} resume attempts")
+        return [job for job in jobs if job.attempts <= max_attempts], dropped
+
+    def close(self):
+        with self._lock:
+            self._db.close()
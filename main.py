@@ -2,10 +2,18 @@ import os
 import math
 import logging
 import yt_dlp
+from yt_dlp.networking.exceptions import HTTPError, TransportError
 import asyncio
 import time
-import tempfile
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import signal
+import shutil
+import hmac
+import hashlib
+import json
+import httpx
+from pathlib import Path
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -15,19 +23,58 @@ from telegram.ext import (
     filters
 )
 from datetime import datetime, timedelta
-from collections import defaultdict
 import threading
 from dotenv import load_dotenv
 import re
-import random
-import string
 from typing import Dict, List, Optional
+from extraction import ExtractionPool, ExtractionQueueFull, ExtractionCancelled, pooled_ydl
+from cache import MetadataCache, FileIdCache, MediaCache, canonical_video_key, trim_info
+from jobs import SingleFlight, ProgressTarget, DownloadScheduler
+from progress import ProgressPump
+from postprocess import AudioEncodeCost, auto_preset, cpu_count, ffmpeg_wrapper_dir, postprocessor_args
+from sessions import BoundedStore, MediaSession, new_token
+from tempdirs import JobDirs
+from journal import JobJournal, JournalEntry
+from ratelimit import (
+    AUDIO_COST,
+    LOOKUP_COST,
+    QuotaExceeded,
+    StatsRecorder,
+    Tier,
+    create_backend,
+    download_cost,
+)
+from streaming import StreamError, source_size, ranged_chunks, stream_upload
+from playlist import PlaylistEntry, playlist_page, page_entries, selection_keyboard, run_pipeline
+from formats import (
+    FileTooLarge,
+    best_under_cap,
+    capped_format_spec,
+    chosen_size,
+    build_format_ladder,
+    estimate_size,
+    best_audio_format,
+    estimate_audio_size,
+    mp3_bitrate_cap,
+    fits,
+    selection_size,
+    streamable_format,
+    short_side,
+)
 
-# Health check server (keep this first)
-from health import run_health_server
-health_thread = threading.Thread(target=run_health_server)
-health_thread.daemon = True
-health_thread.start()
+import health
+from metrics import (
+    ACTIVE_JOBS,
+    CACHE_REQUESTS,
+    DOWNLOAD_SECONDS,
+    DOWNLOAD_THROUGHPUT,
+    ERRORS,
+    EXTRACT_SECONDS,
+    MEDIA_CACHE_BYTES,
+    QUEUE_DEPTH,
+    UPLOAD_SECONDS,
+)
+from health import run_health_server, WebhookServer
 
 # Load environment variables
 load_dotenv()
@@ -41,49 +88,256 @@ logger = logging.getLogger(__name__)
 
 # Configuration
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
+# Optional self-hosted Bot API server (https://github.com/tdlib/telegram-bot-api)
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL")  # e.g. http://localhost:8081/bot
+BOT_API_BASE_FILE_URL = os.getenv("BOT_API_BASE_FILE_URL")  # e.g. http://localhost:8081/file/bot
+BOT_API_LOCAL_MODE = bool(BOT_API_BASE_URL) and os.getenv("BOT_API_LOCAL_MODE", "true").lower() in ("1", "true", "yes")
+if BOT_API_LOCAL_MODE:
+    MAX_FILE_SIZE = 2000 * 1024 * 1024  # 2000MB, local Bot API server limit
+else:
+    MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
 MAX_VIDEO_DURATION = 7200  # 2 hours in seconds
-RATE_LIMIT = timedelta(seconds=30)
-TEMP_DIR = "temp_downloads"
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()  # "polling" or "webhook"
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # public https base URL, e.g. https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+# Every replica must register and check the same secret, so the default is derived from the token
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or (
+    hmac.new(TELEGRAM_BOT_TOKEN.encode(), b"webhook-secret", hashlib.sha256).hexdigest()
+    if TELEGRAM_BOT_TOKEN else None
+)
 SUPPORTED_SITES = ["youtube", "youtu.be", "vimeo", "dailymotion", "tiktok"]
 
-# Create temp directory if not exists
-os.makedirs(TEMP_DIR, exist_ok=True)
+def download_profile(site: str, fragments: int, chunk_size: int = 0) -> Dict:
+    """yt-dlp download tuning for a site, overridable as <SITE>_CONCURRENT_FRAGMENTS / <SITE>_HTTP_CHUNK_SIZE"""
+    name = site.split(".")[0].upper()
+    chunk_size = int(os.getenv(f"{name}_HTTP_CHUNK_SIZE", str(chunk_size)))
+    return {
+        "concurrent_fragment_downloads": int(os.getenv(f"{name}_CONCURRENT_FRAGMENTS", str(fragments))),
+        # Ranged requests keep throttling hosts at full speed; 0 downloads in one request
+        "http_chunk_size": chunk_size or None,
+    }
+
+# Per-site download engine settings, matched like SUPPORTED_SITES
+SITE_PROFILES = {
+    "youtube": download_profile("youtube", 4, 10 * 1024 * 1024),
+    "vimeo": download_profile("vimeo", 8),
+    "dailymotion": download_profile("dailymotion", 8),
+    "tiktok": download_profile("tiktok", 1),
+}
+SITE_PROFILES["youtu.be"] = SITE_PROFILES["youtube"]
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", "4"))
+EXTRACT_QUEUE_SIZE = int(os.getenv("EXTRACT_QUEUE_SIZE", "32"))
+EXTRACT_TIMEOUT = int(os.getenv("EXTRACT_TIMEOUT", "60"))  # seconds
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv("MAX_CONCURRENT_DOWNLOADS", "3"))
+FFMPEG_THREADS = int(os.getenv("FFMPEG_THREADS", "2"))  # threads per ffmpeg job
+# Enough post-processing slots to keep every core busy without oversubscribing it
+MAX_CONCURRENT_POSTPROCESS = int(os.getenv("MAX_CONCURRENT_POSTPROCESS", str(max(1, cpu_count() // FFMPEG_THREADS))))
+FFMPEG_NICE = int(os.getenv("FFMPEG_NICE", "10"))  # ffmpeg runs below the bot's own priority
+FFMPEG_CPUS = os.getenv("FFMPEG_CPUS")  # optional taskset CPU list for ffmpeg, e.g. "2-7"
+FFMPEG_PRESET = os.getenv("FFMPEG_PRESET", "auto").lower()  # "auto", "fast", "balanced" or "quality"
+PROGRESS_EDIT_INTERVAL = float(os.getenv("PROGRESS_EDIT_INTERVAL", "3"))  # seconds between edits per job
+HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL", "2"))  # seconds
+LIVENESS_MAX_AGE = float(os.getenv("LIVENESS_MAX_AGE", "30"))  # seconds
+READY_MAX_QUEUE = int(os.getenv("READY_MAX_QUEUE", "20"))
+READY_MAX_ACTIVE_DOWNLOADS = int(os.getenv("READY_MAX_ACTIVE_DOWNLOADS", str(MAX_CONCURRENT_DOWNLOADS - 1)))  # busy once every slot is taken
+READY_MIN_FREE_TEMP_BYTES = int(os.getenv("READY_MIN_FREE_TEMP_BYTES", str(1024 * 1024 * 1024)))  # 1GB
+# Below this much free disk the media cache is trimmed to make room for downloads
+CLEANUP_MIN_FREE_BYTES = int(os.getenv("CLEANUP_MIN_FREE_BYTES", str(2 * READY_MIN_FREE_TEMP_BYTES)))
+# Job directories older than this are assumed leaked and removed; longer than any download takes
+JOB_DIR_MAX_AGE = int(os.getenv("JOB_DIR_MAX_AGE", "10800"))  # 3 hours
+# Times an interrupted download is resumed after a restart before it is given up
+JOB_RESUME_ATTEMPTS = int(os.getenv("JOB_RESUME_ATTEMPTS", "3"))
+# Times a download cut off by a network error continues from its partial file within one run
+DOWNLOAD_RESUME_ATTEMPTS = int(os.getenv("DOWNLOAD_RESUME_ATTEMPTS", "3"))
+PLAYLIST_MAX_ITEMS = int(os.getenv("PLAYLIST_MAX_ITEMS", "50"))
+PLAYLIST_PREFETCH = int(os.getenv("PLAYLIST_PREFETCH", "1"))  # downloaded items waiting for upload
+PLAYLIST_PAGE_SIZE = 8  # entries per selector page and per flat extraction
+# Playlist items are fetched at up to 720p, picking formats that report a size under the upload limit
+PLAYLIST_MEDIA_TYPE = "format_" + capped_format_spec(720, MAX_FILE_SIZE)
+CACHE_DIR = os.getenv("CACHE_DIR", "cache")
+METADATA_CACHE_TTL = int(os.getenv("METADATA_CACHE_TTL", "21600"))  # 6 hours
+METADATA_CACHE_MEMORY_ENTRIES = int(os.getenv("METADATA_CACHE_MEMORY_ENTRIES", "512"))
+METADATA_CACHE_DISK_ENTRIES = int(os.getenv("METADATA_CACHE_DISK_ENTRIES", "20000"))
+# Finished downloads kept on disk so repeats skip the download; 0 disables the cache
+MEDIA_CACHE_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_BYTES", str(5 * 1024 ** 3)))
+MEDIA_CACHE_LOW_WATERMARK = float(os.getenv("MEDIA_CACHE_LOW_WATERMARK", "0.8"))  # evict down to this share of the budget
+SESSION_TTL = int(os.getenv("SESSION_TTL", "3600"))  # seconds a video card's buttons stay usable
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", "100000"))
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "sqlite").lower()  # "memory", "sqlite" or "redis"
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+STATS_FLUSH_INTERVAL = float(os.getenv("STATS_FLUSH_INTERVAL", "5"))  # seconds between stats writes
+# Rate limit credits: a lookup costs 1, downloads 2-8 depending on quality, cache hits nothing
+FREE_TIER = Tier(
+    "free",
+    int(os.getenv("FREE_TIER_BURST", "20")),
+    1 / float(os.getenv("FREE_TIER_REFILL_SECONDS", "10")),  # one credit back every N seconds
+)
+PREMIUM_TIER = Tier(
+    "premium",
+    int(os.getenv("PREMIUM_TIER_BURST", "100")),
+    1 / float(os.getenv("PREMIUM_TIER_REFILL_SECONDS", "2")),
+)
+PREMIUM_USER_IDS = {int(i) for i in os.getenv("PREMIUM_USER_IDS", "").split(",") if i.strip()}
+ADMIN_USER_IDS = {int(i) for i in os.getenv("ADMIN_USER_IDS", "").split(",") if i.strip()}  # never limited
+# Shared download budget across all users; 0 disables it
+GLOBAL_BANDWIDTH_BYTES_PER_SECOND = int(os.getenv("GLOBAL_BANDWIDTH_BYTES_PER_SECOND", "0"))
+GLOBAL_BANDWIDTH_BURST_BYTES = int(os.getenv("GLOBAL_BANDWIDTH_BURST_BYTES", str(4 * MAX_FILE_SIZE)))
+# Send progressive mp4 formats straight from the source URL into the upload, without a temp file
+STREAM_UPLOADS = os.getenv("STREAM_UPLOADS", "true").lower() in ("1", "true", "yes")
+STREAM_BUFFER_CHUNKS = int(os.getenv("STREAM_BUFFER_CHUNKS", "16"))  # 256KB chunks held between download and upload
+STREAM_RANGE_SIZE = int(os.getenv("STREAM_RANGE_SIZE", str(10 * 1024 * 1024)))  # bytes per source Range request
+# Starting estimate of ffmpeg seconds per second of audio for an MP3 encode, refined as jobs run
+MP3_ENCODE_SECONDS_PER_AUDIO_SECOND = float(os.getenv("MP3_ENCODE_SECONDS_PER_AUDIO_SECOND", "0.02"))
+BANDWIDTH_MAX_WAIT = float(os.getenv("BANDWIDTH_MAX_WAIT", "300"))  # seconds a job may wait for budget
+
+# ffmpeg wrappers applying FFMPEG_NICE and FFMPEG_CPUS, or None to run ffmpeg directly
+FFMPEG_LOCATION = ffmpeg_wrapper_dir(os.path.join(CACHE_DIR, "ffmpeg"), FFMPEG_NICE, FFMPEG_CPUS)
+
+# Rate limits and download stats, shared between replicas unless the backend is "memory"
+limits_backend = create_backend(RATE_LIMIT_BACKEND, os.path.join(CACHE_DIR, "limits.sqlite3"), REDIS_URL)
+user_stats = StatsRecorder(limits_backend, flush_interval=STATS_FLUSH_INTERVAL)
+
+# State behind each card's inline keyboard, keyed by the token in its callback_data
+media_sessions = BoundedStore(ttl=SESSION_TTL, max_entries=SESSION_MAX_ENTRIES)
+playlist_sessions = BoundedStore(ttl=SESSION_TTL, max_entries=SESSION_MAX_ENTRIES)
+
+# Metadata lookups run here so they never block the event loop
+extraction_pool = ExtractionPool(
+    max_workers=EXTRACT_WORKERS,
+    max_queue=EXTRACT_QUEUE_SIZE,
+    timeout=EXTRACT_TIMEOUT,
+)
+
+# Trimmed extract_info results keyed by extractor + video ID
+metadata_cache = MetadataCache(
+    os.path.join(CACHE_DIR, "metadata.sqlite3"),
+    ttl=METADATA_CACHE_TTL,
+    memory_entries=METADATA_CACHE_MEMORY_ENTRIES,
+    disk_entries=METADATA_CACHE_DISK_ENTRIES,
+)
+
+# Telegram file_ids of previous uploads, so repeats skip download and upload
+file_id_cache = FileIdCache(os.path.join(CACHE_DIR, "file_ids.sqlite3"))
 
-# Rate limiting storage
-user_last_request = defaultdict(lambda: datetime.min)
-user_stats = defaultdict(lambda: {"downloads": 0, "last_download": None})
+# Downloaded files keyed by video, format and post-processing recipe; jobs download into its incoming dir
+media_cache = MediaCache(
+    os.path.join(CACHE_DIR, "media"),
+    max_bytes=MEDIA_CACHE_MAX_BYTES,
+    low_watermark=MEDIA_CACHE_LOW_WATERMARK,
+)
+
+# ffmpeg seconds per second of audio for MP3 encodes, refined as jobs run
+audio_encode_cost = AudioEncodeCost(MP3_ENCODE_SECONDS_PER_AUDIO_SECOND)
+
+# Scratch directories for running jobs, on the media cache's filesystem so finished files move in by rename
+job_dirs = JobDirs(
+    media_cache.incoming_dir,
+    os.path.join(CACHE_DIR, "job_dirs.sqlite3"),
+    max_age=JOB_DIR_MAX_AGE,
+    min_free_bytes=CLEANUP_MIN_FREE_BYTES,
+    on_low_space=media_cache.trim,
+)
+
+# Downloads in progress, so a restart can resume them from their partial files
+job_journal = JobJournal(os.path.join(CACHE_DIR, "jobs.sqlite3"))
+
+# Pooled connections for streamed uploads, to the media hosts and to the Bot API
+http_client = httpx.AsyncClient(
+    timeout=httpx.Timeout(connect=30, read=120, write=120, pool=30),
+    follow_redirects=True,
+)
+
+# Identical concurrent downloads share one job keyed by (video key, selection)
+download_flights = SingleFlight()
+
+# Caps concurrent downloads and ffmpeg jobs and queues users fairly
+download_scheduler = DownloadScheduler(
+    max_downloads=MAX_CONCURRENT_DOWNLOADS,
+    max_postprocess=MAX_CONCURRENT_POSTPROCESS,
+)
 
 # Base yt-dlp configuration for downloads
 base_yt_dlp_opts = {
     "quiet": True,
     "no_warnings": True,
     "merge_output_format": "mp4",
-    "outtmpl": os.path.join(TEMP_DIR, "%(title)s.%(ext)s"),
+    "outtmpl": os.path.join(job_dirs.root, "%(title)s.%(ext)s"),
     "socket_timeout": 300,
     "extract_timeout": 600,
     "cookiefile": "cookies.txt",
     "retries": 3,
+    # Pick up an existing .part file instead of starting over
+    "continuedl": True,
     "postprocessors": [],
     "noplaylist": True,
+    "postprocessor_args": postprocessor_args(
+        FFMPEG_THREADS, auto_preset(FFMPEG_THREADS) if FFMPEG_PRESET == "auto" else FFMPEG_PRESET
+    ),
 }
+if FFMPEG_LOCATION:
+    base_yt_dlp_opts["ffmpeg_location"] = FFMPEG_LOCATION
 
-def generate_random_string(length=8):
-    """Generate a random string for temp filenames"""
-    return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
+# Minimal options for info extraction
+info_yt_dlp_opts = {
+    "quiet": True,
+    "no_warnings": True,
+    "cookiefile": "cookies.txt",
+    "socket_timeout": 30,
+    # Playlists only list their first page of entries; single videos are fully resolved
+    "extract_flat": "in_playlist",
+    "playlist_items": f"1:{PLAYLIST_PAGE_SIZE}",
+    "force_generic_extractor": False,
+    "verbose": True,
+    "logger": logger,
+}
 
-async def rate_limit_check(user_id: int) -> bool:
-    """Check if user is within rate limit"""
-    key = str(user_id)
-    if user_last_request[key] + RATE_LIMIT > datetime.now():
-        return False
-    user_last_request[key] = datetime.now()
-    return True
+def user_tier(user_id: int) -> Optional[Tier]:
+    """The user's rate limit tier, or None for admins"""
+    if user_id in ADMIN_USER_IDS:
+        return None
+    if user_id in PREMIUM_USER_IDS:
+        return PREMIUM_TIER
+    return FREE_TIER
+
+async def charge(user_id: int, cost: float) -> float:
+    """Take cost credits from the user's bucket; returns 0 if allowed, else seconds to wait"""
+    tier = user_tier(user_id)
+    if tier is None or cost <= 0:
+        return 0.0
+    try:
+        allowed, retry_after = await limits_backend.take(
+            f"user:{user_id}", min(cost, tier.capacity), tier.capacity, tier.rate
+        )
+    except Exception as e:
+        # Fail open: an unreachable backend should not lock everyone out
+        logger.error(f"Rate limit backend error: {e}")
+        return 0.0
+    return 0.0 if allowed else retry_after
+
+async def reserve_bandwidth(size: Optional[int]):
+    """Wait until the global bandwidth budget covers an estimated download size"""
+    if not GLOBAL_BANDWIDTH_BYTES_PER_SECOND:
+        return
+    # Unknown sizes are charged a quarter of the upload limit
+    cost = min(size or MAX_FILE_SIZE // 4, GLOBAL_BANDWIDTH_BURST_BYTES)
+    deadline = time.monotonic() + BANDWIDTH_MAX_WAIT
+    while True:
+        try:
+            allowed, retry_after = await limits_backend.take(
+                "global:bandwidth", cost, GLOBAL_BANDWIDTH_BURST_BYTES, GLOBAL_BANDWIDTH_BYTES_PER_SECOND
+            )
+        except Exception as e:
+            logger.error(f"Rate limit backend error: {e}")
+            return
+        if allowed:
+            return
+        if time.monotonic() + retry_after > deadline:
+            raise QuotaExceeded("The bot is at its bandwidth limit right now. Please try again in a few minutes.")
+        await asyncio.sleep(retry_after)
 
 def update_user_stats(user_id: int):
     """Update user download statistics"""
-    user_stats[str(user_id)]["downloads"] += 1
-    user_stats[str(user_id)]["last_download"] = datetime.now()
+    user_stats.record(user_id)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command"""
@@ -108,28 +362,28 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ])
     )
 
-def make_progress_hook(context, chat_id, message_id, use_caption=False):
-    """Create a progress hook with proper async handling"""
-    last_update = 0
-    last_percent = 0
+async def edit_progress(context, target: ProgressTarget, text: str):
+    """Edit a progress message, whether it is a photo caption or plain text"""
+    if target.use_caption:
+        return await context.bot.edit_message_caption(
+            chat_id=target.chat_id,
+            message_id=target.message_id,
+            caption=text
+        )
+    return await context.bot.edit_message_text(
+        chat_id=target.chat_id,
+        message_id=target.message_id,
+        text=text
+    )
 
+def make_progress_hook(pump: ProgressPump):
+    """Create a progress hook that hands rendered progress to the pump without blocking"""
     def progress_hook(d):
-        nonlocal last_update, last_percent
         try:
             if d['status'] == 'downloading':
-                current_time = time.time()
-                current_percent = (d.get('downloaded_bytes', 0) / (d.get('total_bytes') or d.get('total_bytes_estimate', 1)) * 100)
-                
-                # Only update if significant change (5%) or 1 second passed
-                if current_time - last_update < 1.0 and abs(current_percent - last_percent) < 5:
-                    return
-                
-                last_update = current_time
-                last_percent = current_percent
-
                 downloaded = d.get('downloaded_bytes', 0)
-                total = d.get('total_bytes') or d.get('total_bytes_estimate', 1)
-                percent = downloaded / total * 100
+                total = d.get('total_bytes') or d.get('total_bytes_estimate') or 1
+                percent = min(downloaded / total * 100, 100.0)
                 blocks = math.floor(percent / 5)
                 progress_bar = f"[{'█' * blocks}{'░' * (20 - blocks)}] {percent:.1f}%"
                 
@@ -139,42 +393,13 @@ def make_progress_hook(context, chat_id, message_id, use_caption=False):
                 speed_info = ""
                 if speed and eta:
                     speed_mb = speed / (1024 * 1024)
-                    eta_str = str(timedelta(seconds=eta))
+                    eta_str = str(timedelta(seconds=int(eta)))
                     speed_info = f"\n🚀 {speed_mb:.1f} MB/s | ⏳ {eta_str}"
 
-                if use_caption:
-                    coro = context.bot.edit_message_caption(
-                        chat_id=chat_id,
-                        message_id=message_id,
-                        caption=f"⏳ Downloading...\n{progress_bar}{speed_info}"
-                    )
-                else:
-                    coro = context.bot.edit_message_text(
-                        chat_id=chat_id,
-                        message_id=message_id,
-                        text=f"⏳ Downloading...\n{progress_bar}{speed_info}"
-                    )
-
-                loop = asyncio.get_event_loop()
-                future = asyncio.run_coroutine_threadsafe(coro, loop)
-                future.result(timeout=5)
+                pump.publish(f"⏳ Downloading...\n{progress_bar}{speed_info}")
 
             elif d['status'] == 'finished':
-                if use_caption:
-                    coro = context.bot.edit_message_caption(
-                        chat_id=chat_id,
-                        message_id=message_id,
-                        caption="✅ Processing complete! Uploading file..."
-                    )
-                else:
-                    coro = context.bot.edit_message_text(
-                        chat_id=chat_id,
-                        message_id=message_id,
-                        text="✅ Processing complete! Uploading file..."
-                    )
-                loop = asyncio.get_event_loop()
-                future = asyncio.run_coroutine_threadsafe(coro, loop)
-                future.result(timeout=5)
+                pump.publish("⚙️ Download finished! Processing file...")
         except Exception as e:
             logger.error(f"Progress hook error: {e}")
 
@@ -184,6 +409,10 @@ def is_supported_url(url: str) -> bool:
     """Check if URL is from a supported site"""
     return any(site in url.lower() for site in SUPPORTED_SITES)
 
+def site_profile(url: str) -> Dict:
+    """Download engine settings for the site a URL belongs to"""
+    return next((profile for site, profile in SITE_PROFILES.items() if site in url.lower()), {})
+
 def format_duration(seconds: int) -> str:
     """Format duration in seconds to HH:MM:SS"""
     return str(timedelta(seconds=seconds))
@@ -198,6 +427,136 @@ def format_size(bytes: int) -> str:
     s = round(bytes / p, 2)
     return f"{s} {size_name[i]}"
 
+async def fetch_video_info(url: str, lookup_key) -> Dict:
+    """Return video info from the metadata cache, extracting it on a miss"""
+    video_key = canonical_video_key(url)
+    info = await metadata_cache.get(video_key)
+    if info:
+        CACHE_REQUESTS.inc(cache="metadata", result="hit")
+        logger.info(f"Metadata cache hit for {video_key}")
+        return info
+    CACHE_REQUESTS.inc(cache="metadata", result="miss")
+
+    def extract():
+        with pooled_ydl(info_yt_dlp_opts) as ydl:
+            return ydl.extract_info(url, download=False)
+
+    with EXTRACT_SECONDS.time():
+        info = await extraction_pool.run(lookup_key, extract)
+    if not info:
+        raise ValueError("❌ Unable to extract video information. Please check the URL.")
+    if info.get('_type') == 'playlist':
+        return info
+
+    info = trim_info(info)
+    await metadata_cache.put(video_key, info)
+    return info
+
+def playlist_page_key(url: str, page: int) -> str:
+    return f"playlist:{url}:{page}"
+
+async def fetch_playlist_page(url: str, page: int, lookup_key) -> Dict:
+    """One page of flat playlist entries, extracting only that slice on a miss"""
+    cache_key = playlist_page_key(url, page)
+    cached = await metadata_cache.get(cache_key)
+    if cached:
+        CACHE_REQUESTS.inc(cache="metadata", result="hit")
+        return cached
+    CACHE_REQUESTS.inc(cache="metadata", result="miss")
+
+    start = page * PLAYLIST_PAGE_SIZE
+
+    def extract():
+        with pooled_ydl(info_yt_dlp_opts, playlist_items=f"{start + 1}:{start + PLAYLIST_PAGE_SIZE}") as ydl:
+            return ydl.extract_info(url, download=False)
+
+    with EXTRACT_SECONDS.time():
+        info = await extraction_pool.run(lookup_key, extract)
+    if not info or info.get('_type') != 'playlist':
+        raise ValueError("❌ Unable to load this playlist page.")
+    result = playlist_page(info)
+    await metadata_cache.put(cache_key, result)
+    return result
+
+async def playlist_entry(playlist: Dict, index: int, lookup_key) -> PlaylistEntry:
+    """Resolve a playlist position to its entry, loading only the page it is on"""
+    page, offset = divmod(index, PLAYLIST_PAGE_SIZE)
+    entries = page_entries(await fetch_playlist_page(playlist["url"], page, lookup_key))
+    if offset >= len(entries):
+        raise ValueError("No longer in the playlist")
+    return entries[offset]
+
+async def playlist_length(playlist: Dict, lookup_key) -> int:
+    """Entries to download for "Download All", paging only when the count is unknown"""
+    if playlist["count"]:
+        return min(playlist["count"], PLAYLIST_MAX_ITEMS)
+    length, page = 0, 0
+    while length < PLAYLIST_MAX_ITEMS:
+        entries = (await fetch_playlist_page(playlist["url"], page, lookup_key))["entries"]
+        length += len(entries)
+        if len(entries) < PLAYLIST_PAGE_SIZE:
+            break
+        page += 1
+    return min(length, PLAYLIST_MAX_ITEMS)
+
+async def send_media(context, chat_id: int, kind: str, media, info: Dict):
+    """Send a file object or Telegram file_id as audio, video or document"""
+    if kind == "audio":
+        return await context.bot.send_audio(
+            chat_id=chat_id,
+            audio=media,
+            title=info.get('title', 'audio_file'),
+            performer=info.get('uploader', ''),
+            duration=info.get('duration'),
+            read_timeout=120,
+            write_timeout=120
+        )
+    if kind == "document":
+        return await context.bot.send_document(
+            chat_id=chat_id,
+            document=media,
+            caption=f"🎬 {info.get('title', 'video_file')}",
+            read_timeout=120,
+            write_timeout=120
+        )
+    return await context.bot.send_video(
+        chat_id=chat_id,
+        video=media,
+        supports_streaming=True,
+        duration=info.get('duration'),
+        width=info.get('width'),
+        height=info.get('height'),
+        caption=f"🎬 {info.get('title', 'video_file')}",
+        read_timeout=120,
+        write_timeout=120
+    )
+
+async def remember_file_id(video_key: Optional[str], media_type: str, message):
+    """Index the file_id of an uploaded message for later re-sends"""
+    for kind in ("video", "audio", "document"):
+        media = getattr(message, kind, None)
+        if media:
+            await file_id_cache.put(video_key, media_type, kind, media.file_id)
+            return
+
+async def send_cached_media(context, chat_id: int, video_key: Optional[str], media_type: str, info: Dict) -> bool:
+    """Re-send a previous upload by file_id; returns False if there is none usable"""
+    cached = await file_id_cache.get(video_key, media_type)
+    if not cached:
+        CACHE_REQUESTS.inc(cache="file_id", result="miss")
+        return False
+    kind, file_id = cached
+    try:
+        await send_media(context, chat_id, kind, file_id, info)
+    except BadRequest as e:
+        CACHE_REQUESTS.inc(cache="file_id", result="stale")
+        logger.warning(f"Stale file_id for {video_key} {media_type}: {e}")
+        await file_id_cache.invalidate(video_key, media_type)
+        return False
+    CACHE_REQUESTS.inc(cache="file_id", result="hit")
+    logger.info(f"Served {video_key} {media_type} from file_id cache")
+    return True
+
 def get_video_info_markdown(info: Dict) -> str:
     """Generate formatted video info in Markdown"""
     title = info.get('title', 'Unknown Title')
@@ -218,15 +577,6 @@ def get_video_info_markdown(info: Dict) -> str:
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Main message handler for incoming video URLs"""
     user_id = update.effective_user.id
-    if not await rate_limit_check(user_id):
-        await update.message.reply_text(
-            f"⏳ Please wait {RATE_LIMIT.seconds} seconds between requests",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🆘 Help", callback_data="help_button")]
-            ])
-        )
-        return
-
     url = update.message.text.strip()
     
     # Validate URL
@@ -250,6 +600,18 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
+    # Invalid links above are free, and so are lookups the metadata cache can answer
+    cost = 0 if await metadata_cache.get(canonical_video_key(url)) else LOOKUP_COST
+    wait = await charge(user_id, cost)
+    if wait:
+        await update.message.reply_text(
+            f"⏳ You're out of request credits. Please try again in {math.ceil(wait)} seconds",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🆘 Help", callback_data="help_button")]
+            ])
+        )
+        return
+
     # Send initial processing message
     processing_msg = await update.message.reply_text(
         "🔍 Processing your link...",
@@ -259,112 +621,190 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
     try:
-        # Minimal options for info extraction
-        info_opts = {
-            "quiet": True,
-            "no_warnings": True,
-            "cookiefile": "cookies.txt",
-            "socket_timeout": 30,
-            "extract_flat": False,
-            "force_generic_extractor": False,
-            "verbose": True,
-            "logger": logger,
-        }
-
-        with yt_dlp.YoutubeDL(info_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            if not info:
-                raise ValueError("❌ Unable to extract video information. Please check the URL.")
-            
-            # Check for playlists
-            if info.get('_type') == 'playlist':
-                await processing_msg.edit_text(
-                    "🎵 Playlist detected! How would you like to proceed?",
-                    reply_markup=InlineKeyboardMarkup([
-                        [
-                            InlineKeyboardButton("📼 Download All", callback_data="playlist_all"),
-                            InlineKeyboardButton("🎬 Select Videos", callback_data="playlist_select")
-                        ],
-                        [InlineKeyboardButton("❌ Cancel", callback_data="cancel_download")]
-                    ])
+        lookup_key = (processing_msg.chat_id, processing_msg.message_id)
+        info = await fetch_video_info(url, lookup_key)
+
+        # Check for playlists
+        if info.get('_type') == 'playlist':
+            # Only the first page was extracted; later pages load as the user pages or downloads
+            page = playlist_page(info)
+            if not page["entries"]:
+                raise ValueError("❌ This playlist has no downloadable videos.")
+            await metadata_cache.put(playlist_page_key(url, 0), page)
+            token = new_token()
+            count = f" ({page['count']} videos)" if page["count"] else ""
+            await processing_msg.edit_text(
+                f"🎵 Playlist detected: {page['title']}{count}\n"
+                "How would you like to proceed?",
+                reply_markup=InlineKeyboardMarkup([
+                    [
+                        InlineKeyboardButton("📼 Download All", callback_data=f"pl:{token}:all"),
+                        InlineKeyboardButton("🎬 Select Videos", callback_data=f"pl:{token}:select")
+                    ],
+                    [InlineKeyboardButton("❌ Cancel", callback_data="cancel_download")]
+                ])
+            )
+            playlist_sessions.set(token, {
+                "token": token,
+                "url": url,
+                "count": page["count"],
+                "page": 0,
+                "selected": set(),
+                "done": set(),
+                "pending": [],
+                "running": False,
+            })
+            return
+        
+        # Single video checks
+        if info.get("is_live"):
+            raise ValueError("📡 Live streams are not supported")
+        
+        duration = info.get("duration") or 0
+        if duration > MAX_VIDEO_DURATION:
+            raise ValueError(
+                f"⏳ Videos longer than {MAX_VIDEO_DURATION//3600} hours are not supported "
+                f"(your video: {format_duration(duration)})"
+            )
+
+        # Build a resolution ladder of merged video+audio options
+        formats = info.get("formats", [])
+        ladder = build_format_ladder(info, MAX_FILE_SIZE)
+        video_formats = [f for f in formats if f.get("vcodec") != "none" and f.get("acodec") != "none"]
+        if not ladder and not video_formats:
+            raise ValueError("❌ No suitable video formats found.")
+
+        # Buttons carry the card's token and an index into its options, so long
+        # format specs never hit Telegram's 64-byte callback_data limit
+        token = new_token()
+        options: List[str] = []
+        costs: List[int] = []
+
+        def option(media_type: str, cost: int) -> str:
+            options.append(media_type)
+            costs.append(cost)
+            return f"dl:{token}:{len(options) - 1}"
+
+        # Prepare quality buttons, led by the best selection that fits the limit
+        keyboard = []
+        best = best_under_cap(info, MAX_FILE_SIZE)
+        if best:
+            best_spec, best_format, best_size = best
+            keyboard.append([
+                InlineKeyboardButton(
+                    f"⭐ Best under {format_size(MAX_FILE_SIZE)} ({short_side(best_format) or '?'}p, ~{format_size(best_size)})",
+                    callback_data=option(f"format_{best_spec}", download_cost(short_side(best_format)))
                 )
-                context.user_data["playlist_info"] = info
-                context.user_data["url"] = url
-                return
-            
-            # Single video checks
-            if info.get("is_live"):
-                raise ValueError("📡 Live streams are not supported")
-            
-            duration = info.get("duration", 0)
-            if duration > MAX_VIDEO_DURATION:
-                raise ValueError(
-                    f"⏳ Videos longer than {MAX_VIDEO_DURATION//3600} hours are not supported "
-                    f"(your video: {format_duration(duration)})"
+            ])
+        for rung in ladder:
+            if best and rung["spec"] == best[0]:
+                continue
+            filesize = f"~{format_size(rung['size'])}" if rung["size"] else "size unknown"
+            keyboard.append([
+                InlineKeyboardButton(
+                    f"🎥 {rung['height']}p ({rung['ext'].upper()}, {filesize})",
+                    callback_data=option(f"format_{rung['spec']}", download_cost(rung["height"]))
                 )
+            ])
 
-            # Get available formats
-            formats = info.get("formats", [])
-            video_formats = [f for f in formats if f.get("vcodec") != "none" and f.get("acodec") != "none"]
-            if not video_formats:
-                raise ValueError("❌ No suitable video formats found.")
-            
-            # Sort formats by resolution and select top 3
+        if not ladder:
+            # No resolution info to build a ladder from; offer the top progressive formats
+            video_formats = [f for f in video_formats if fits(estimate_size(f, duration), MAX_FILE_SIZE)]
             video_formats = sorted(
                 video_formats,
-                key=lambda f: (f.get('height', 0), f.get('width', 0), f.get('tbr', 0)),
+                key=lambda f: (f.get('height') or 0, f.get('width') or 0, f.get('tbr') or 0),
                 reverse=True
             )
-            selected_video_formats = video_formats[:3]
-
-            # Prepare quality buttons
-            keyboard = []
-            for f in selected_video_formats:
+            for f in video_formats[:3]:
                 format_id = f["format_id"]
+                if best and format_id == best[0]:
+                    continue
                 quality = f.get("format_note", f"{f.get('height', 'Unknown')}p")
                 ext = f.get("ext", "?")
-                filesize = format_size(f.get('filesize', 0))
+                size = estimate_size(f, duration)
+                filesize = f"~{format_size(size)}" if size else "size unknown"
                 keyboard.append([
                     InlineKeyboardButton(
-                        f"🎥 {quality} ({ext.upper()}, ~{filesize})", 
-                        callback_data=f"format_{format_id}"
+                        f"🎥 {quality} ({ext.upper()}, {filesize})", 
+                        callback_data=option(f"format_{format_id}", download_cost(short_side(f)))
                     )
                 ])
 
-            # Audio options
-            keyboard.append([
-                InlineKeyboardButton("🎵 MP3 Audio (128kbps)", callback_data="audio_128"),
-                InlineKeyboardButton("🎵 MP3 Audio (320kbps)", callback_data="audio_320")
-            ])
+        # Audio options that fit the upload limit; MP3 is never encoded above the source bitrate
+        source_audio = best_audio_format(info)
+        audio_buttons = [
+            InlineKeyboardButton(f"🎵 MP3 Audio ({bitrate}kbps)", callback_data=option(f"audio_{bitrate}", AUDIO_COST))
+            for bitrate in sorted({min(b, mp3_bitrate_cap(source_audio)) for b in (128, 320)})
+            if fits(estimate_audio_size(bitrate, duration), MAX_FILE_SIZE)
+        ]
+        if audio_buttons:
+            keyboard.append(audio_buttons)
+        if source_audio:
+            # The source track as served, copied into its container without re-encoding
+            size = estimate_size(source_audio, duration)
+            if fits(size, MAX_FILE_SIZE):
+                details = [source_audio.get("ext", "?").upper()]
+                if source_audio.get("abr"):
+                    details.append(f"{round(source_audio['abr'])}kbps")
+                if size:
+                    details.append(f"~{format_size(size)}")
+                keyboard.append([InlineKeyboardButton(
+                    f"🎧 Original audio ({', '.join(details)})", callback_data=option("audio_original", AUDIO_COST)
+                )])
+        if not keyboard:
+            raise FileTooLarge(
+                f"📁 Every available format is larger than the {format_size(MAX_FILE_SIZE)} Telegram limit"
+            )
 
-            # Get best thumbnail
-            thumbnails = info.get("thumbnails", [])
-            thumb = next((t for t in reversed(thumbnails) if t.get("url")), None)
-            
-            # Format video info
-            caption = get_video_info_markdown(info)
-
-            # Edit the processing message with the options
-            if thumb:
-                await processing_msg.delete()  # Delete the processing message
-                await update.message.reply_photo(
-                    photo=thumb["url"],
-                    caption=caption,
-                    parse_mode="Markdown",
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
-            else:
-                await processing_msg.edit_text(
-                    caption,
-                    parse_mode="Markdown",
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
-            
-            # Save URL and info for callback
-            context.user_data["url"] = url
-            context.user_data["info"] = info
+        # Get best thumbnail
+        thumbnails = info.get("thumbnails", [])
+        thumb = next((t for t in reversed(thumbnails) if t.get("url")), None)
+        
+        # Format video info
+        caption = get_video_info_markdown(info)
 
+        # Edit the processing message with the options
+        if thumb:
+            await processing_msg.delete()  # Delete the processing message
+            await update.message.reply_photo(
+                photo=thumb["url"],
+                caption=caption,
+                parse_mode="Markdown",
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+        else:
+            await processing_msg.edit_text(
+                caption,
+                parse_mode="Markdown",
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+        
+        # Keep only what the buttons need; the full info stays in the metadata cache
+        media_sessions.set(token, MediaSession(url, canonical_video_key(url), info, options, costs))
+
+    except ExtractionCancelled:
+        # The cancel callback has already updated the message
+        logger.info(f"Lookup cancelled by user {user_id}")
+    except ExtractionQueueFull as e:
+        record_error(e)
+        logger.warning(f"Extraction pool saturated: {e}")
+        await processing_msg.edit_text(
+            "⏳ The bot is busy right now. Please try again in a minute.",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🆘 Help", callback_data="help_button")]
+            ])
+        )
+    except asyncio.TimeoutError as e:
+        record_error(e)
+        logger.error(f"Metadata lookup timed out for {url}")
+        await processing_msg.edit_text(
+            f"❌ Timed out fetching video information after {EXTRACT_TIMEOUT} seconds. Please try again.",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🆘 Help", callback_data="help_button")]
+            ])
+        )
     except yt_dlp.utils.DownloadError as e:
+        record_error(e)
         logger.error(f"Download error: {e}")
         await processing_msg.edit_text(
             f"❌ Download error: {str(e)[:200]}",
@@ -373,6 +813,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ])
         )
     except Exception as e:
+        record_error(e)
         logger.error(f"Error in handle_message: {e}")
         await processing_msg.edit_text(
             f"❌ Error: {str(e)[:200]}",
@@ -381,6 +822,413 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ])
         )
 
+def record_error(e: Exception):
+    """Count a failed request by exception type"""
+    ERRORS.inc(type=type(e).__name__)
+
+def describe_download_error(e: Exception) -> str:
+    """Turn a download failure into a message for the user"""
+    if isinstance(e, QuotaExceeded):
+        return f"🚦 {e}"
+    if isinstance(e, FileNotFoundError):
+        logger.error(f"File not found error: {e}")
+        return "❌ Error: The downloaded file could not be found. Please try again."
+    if isinstance(e, yt_dlp.utils.DownloadError):
+        logger.error(f"Download error: {e}")
+        return f"❌ Download failed: {str(e)[:200]}"
+    logger.error(f"Unexpected error: {e}", exc_info=True)
+    return f"❌ Error: {str(e)[:200]}"
+
+def is_transient(e: yt_dlp.utils.DownloadError) -> bool:
+    """Whether a download failed on the network and can continue from its partial file"""
+    cause = e.exc_info[1] if e.exc_info else None
+    if isinstance(cause, HTTPError):
+        return cause.status >= 500
+    # ContentTooShortError is how yt-dlp reports a connection closed mid-file
+    return isinstance(cause, (TransportError, yt_dlp.utils.ContentTooShortError, ConnectionError, TimeoutError))
+
+def download_opts(url: str, media_type: str, info: Optional[Dict]) -> Dict:
+    """yt-dlp options for downloading media_type from url, without hooks or output path"""
+    opts = base_yt_dlp_opts.copy()
+    opts.update(site_profile(url))
+    # Safety net: yt-dlp refuses to fetch a format that reports a larger size
+    opts["max_filesize"] = MAX_FILE_SIZE
+    
+    # Set format based on selection
+    if media_type == "audio_original":
+        # "best" keeps the source codec: m4a is sent as is, other tracks are stream-copied
+        opts.update({
+            "format": "bestaudio[ext=m4a]/bestaudio/best",
+            "postprocessors": [{
+                "key": "FFmpegExtractAudio",
+                "preferredcodec": "best",
+            }],
+        })
+    elif media_type.startswith("audio_"):
+        quality = int(media_type.split("_")[1])
+        if info:
+            quality = min(quality, mp3_bitrate_cap(best_audio_format(info)))
+        # The same m4a preference as best_audio_format, so the cap is taken from the track that is encoded
+        opts.update({
+            "format": "bestaudio[ext=m4a]/bestaudio/best",
+            "postprocessors": [{
+                "key": "FFmpegExtractAudio",
+                "preferredcodec": "mp3",
+                "preferredquality": str(quality),
+            }],
+        })
+    elif media_type.startswith("format_"):
+        opts["format"] = media_type.split("_", 1)[1]
+    return opts
+
+def media_cache_key(video_key: Optional[str], opts: Dict) -> Optional[str]:
+    """Media cache key for the file opts would produce: the video, format and post-processing recipe"""
+    if not video_key:
+        return None
+    recipe = [
+        opts.get("format"),
+        opts.get("postprocessors"),
+        opts.get("merge_output_format"),
+        opts["postprocessor_args"].get("extractaudio"),
+    ]
+    return f"{video_key}|{json.dumps(recipe, sort_keys=True)}"
+
+async def download_media(
+    context,
+    url: str,
+    media_type: str,
+    video_key: Optional[str],
+    targets: List[ProgressTarget],
+    temp_dir: str,
+    info: Optional[Dict] = None,
+):
+    """Return (filename, info) for the selected format, from the media cache or downloaded via temp_dir.
+
+    The file is pinned in the media cache when it is served from or added
+    to it; callers pass filename to media_cache.release() once done.
+    """
+    opts = download_opts(url, media_type, info)
+    cache_key = media_cache_key(video_key, opts)
+    cached = media_cache.acquire(cache_key)
+    if cached:
+        CACHE_REQUESTS.inc(cache="media", result="hit")
+        logger.info(f"Serving {video_key} ({media_type}) from the media cache")
+        return cached, info or await metadata_cache.get(video_key) or {}
+    CACHE_REQUESTS.inc(cache="media", result="miss")
+
+    # Named after the job directory, so a resumed job finds its own .part files
+    stem = os.path.basename(temp_dir)
+    postprocess_gate = download_scheduler.new_postprocess_gate()
+    opts["postprocessor_hooks"] = [postprocess_gate]
+
+    # Hold back until the shared bandwidth budget covers this download
+    if media_type == "audio_original":
+        expected_size = estimate_size(best_audio_format(info or {}) or {}, (info or {}).get("duration"))
+    elif media_type.startswith("audio_"):
+        expected_size = estimate_audio_size(int(opts["postprocessors"][0]["preferredquality"]), (info or {}).get("duration"))
+    else:
+        expected_size = selection_size(info or {}, media_type.split("_", 1)[1])
+    await reserve_bandwidth(expected_size)
+
+    # Write into the job's temporary directory
+    opts["outtmpl"] = os.path.join(temp_dir, f"{stem}.%(ext)s")
+
+    # Progress edits are applied by the pump so the download thread never waits on Telegram
+    pump = ProgressPump(
+        lambda: targets,
+        lambda target, text: edit_progress(context, target, text),
+        min_interval=PROGRESS_EDIT_INTERVAL,
+    )
+    opts["progress_hooks"] = [make_progress_hook(pump)]
+    try:
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            # Download the file in a separate thread
+            def download():
+                try:
+                    for attempt in range(1, DOWNLOAD_RESUME_ATTEMPTS + 1):
+                        try:
+                            return ydl.extract_info(url, download=True)
+                        except yt_dlp.utils.DownloadError as e:
+                            if attempt == DOWNLOAD_RESUME_ATTEMPTS or not is_transient(e):
+                                raise
+                            logger.warning(f"Download interrupted ({e}), resuming from the partial file")
+                            time.sleep(min(2 ** attempt, 30))
+                except Exception as e:
+                    logger.error(f"Download thread error: {e}")
+                    raise
+                finally:
+                    postprocess_gate.release()
+
+            download_started = time.monotonic()
+            downloaded_info = await asyncio.get_running_loop().run_in_executor(download_scheduler.executor, download)
+            download_elapsed = time.monotonic() - download_started
+            DOWNLOAD_SECONDS.observe(download_elapsed)
+        await pump.close("✅ Processing complete! Uploading file...")
+    finally:
+        await pump.close()
+
+    # Reuse the metadata from the download instead of extracting again
+    if not info and downloaded_info:
+        info = trim_info(downloaded_info)
+        await metadata_cache.put(video_key, info)
+    info = info or {}
+
+    downloaded_files = [f for f in os.listdir(temp_dir) if f.startswith(stem)]
+    if not downloaded_files:
+        if media_type.startswith("format_"):
+            # yt-dlp skips a format over max_filesize without raising
+            expected_size = (
+                selection_size(info, media_type.split("_", 1)[1])
+                or (downloaded_info and chosen_size(downloaded_info))
+            )
+            if expected_size and expected_size > MAX_FILE_SIZE:
+                raise FileTooLarge(f"📁 This format (~{format_size(expected_size)}) exceeds the Telegram limit ({format_size(MAX_FILE_SIZE)})")
+        raise FileNotFoundError("No downloaded files found")
+    filename = os.path.join(temp_dir, downloaded_files[0])
+
+    file_size = os.path.getsize(filename)
+    if file_size == 0:
+        raise ValueError("Downloaded file is empty (0 bytes)")
+    
+    if file_size > MAX_FILE_SIZE:
+        raise FileTooLarge(f"📁 File size ({format_size(file_size)}) exceeds Telegram limit ({format_size(MAX_FILE_SIZE)})")
+    DOWNLOAD_THROUGHPUT.observe(file_size / max(download_elapsed, 0.001))
+    if media_type.startswith("audio_"):
+        saved = audio_encode_cost.record(
+            media_type == "audio_original", postprocess_gate.elapsed.get("ExtractAudio", 0.0), info.get("duration")
+        )
+        if saved:
+            logger.info(f"Copied audio without encoding, saving about {saved:.1f}s of ffmpeg time")
+    return media_cache.put(cache_key, filename), info
+
+async def upload_media(context, chat_id: int, media_type: str, video_key: Optional[str], filename: str, info: Dict):
+    """Upload a downloaded file, index its file_id and return (kind, file_id)"""
+    try:
+        kind = "audio" if media_type.startswith("audio_") else "video"
+        with UPLOAD_SECONDS.time(kind=kind):
+            if BOT_API_LOCAL_MODE:
+                # The local server reads the file from disk itself, so the bytes never pass through Python
+                sent = await send_media(context, chat_id, kind, Path(filename).absolute(), info)
+            else:
+                with open(filename, "rb") as f:
+                    sent = await send_media(context, chat_id, kind, f, info)
+    except Exception as upload_error:
+        logger.error(f"File upload failed: {upload_error}")
+        raise ValueError("Failed to upload file to Telegram")
+
+    await remember_file_id(video_key, media_type, sent)
+    for kind in ("video", "audio", "document"):
+        media = getattr(sent, kind, None)
+        if media:
+            return kind, media.file_id
+    raise ValueError("Telegram did not return the uploaded file")
+
+async def stream_and_send(
+    context,
+    url: str,
+    media_type: str,
+    video_key: Optional[str],
+    targets: List[ProgressTarget],
+    info: Dict,
+    fmt: Dict,
+):
+    """Pipe a progressive format from its source URL into sendVideo and return (kind, file_id)"""
+    # Format URLs expire, so resolve a fresh one for just this format
+    def resolve():
+        with pooled_ydl(info_yt_dlp_opts, format=fmt["format_id"]) as ydl:
+            return ydl.extract_info(url, download=False)
+
+    lookup_key = (targets[0].chat_id, targets[0].message_id)
+    with EXTRACT_SECONDS.time():
+        resolved = await extraction_pool.run(lookup_key, resolve)
+    source_url = resolved.get("url") if resolved else None
+    if not source_url:
+        raise StreamError("No direct URL for the selected format")
+    headers = resolved.get("http_headers") or {}
+
+    size = await source_size(http_client, source_url, headers)
+    if not size:
+        raise StreamError("Source did not report its size")
+    if size > MAX_FILE_SIZE:
+        raise FileTooLarge(f"📁 File size ({format_size(size)}) exceeds Telegram limit ({format_size(MAX_FILE_SIZE)})")
+    await reserve_bandwidth(size)
+
+    pump = ProgressPump(
+        lambda: targets,
+        lambda target, text: edit_progress(context, target, text),
+        min_interval=PROGRESS_EDIT_INTERVAL,
+    )
+
+    def on_progress(sent: int, total: int):
+        pump.publish(f"📤 Streaming to Telegram: {format_size(sent)} / {format_size(total)} ({sent * 100 // total}%)")
+
+    started = time.monotonic()
+    try:
+        with UPLOAD_SECONDS.time(kind="video"):
+            result = await stream_upload(
+                http_client,
+                f"{context.bot.base_url}/sendVideo",
+                {
+                    "chat_id": targets[0].chat_id,
+                    "supports_streaming": "true",
+                    "duration": info.get("duration"),
+                    "width": fmt.get("width"),
+                    "height": fmt.get("height"),
+                    "caption": f"🎬 {info.get('title', 'video_file')}",
+                },
+                "video",
+                f"{info.get('id') or 'video'}.mp4",
+                "video/mp4",
+                ranged_chunks(http_client, source_url, headers, size, STREAM_RANGE_SIZE),
+                size,
+                on_progress=on_progress,
+                buffer_chunks=STREAM_BUFFER_CHUNKS,
+            )
+    finally:
+        await pump.close()
+    DOWNLOAD_THROUGHPUT.observe(size / max(time.monotonic() - started, 0.001))
+
+    sent = Message.de_json(result, context.bot)
+    await remember_file_id(video_key, media_type, sent)
+    for kind in ("video", "document"):
+        media = getattr(sent, kind, None)
+        if media:
+            return kind, media.file_id
+    raise ValueError("Telegram did not return the uploaded file")
+
+async def download_and_send(
+    context,
+    url: str,
+    media_type: str,
+    video_key: Optional[str],
+    targets: List[ProgressTarget],
+    job_id: str,
+    info: Optional[Dict] = None,
+    resume: Optional[JournalEntry] = None,
+):
+    """Download the selected format, upload it to the first target's chat and return (kind, file_id).
+
+    A full download records its job directory in job_id's journal entry;
+    resume continues one that a restart interrupted, in its original job
+    directory when it had one.
+    """
+    # A local Bot API server reads files from disk anyway, so streaming gains nothing there
+    fmt = None
+    if STREAM_UPLOADS and not BOT_API_LOCAL_MODE and not resume and info and media_type.startswith("format_"):
+        # A cached copy is uploaded from disk instead of fetched again
+        if not media_cache.contains(media_cache_key(video_key, download_opts(url, media_type, info))):
+            fmt = streamable_format(info, media_type.split("_", 1)[1])
+    if fmt:
+        try:
+            return await stream_and_send(context, url, media_type, video_key, targets, info, fmt)
+        except (FileTooLarge, QuotaExceeded, ExtractionCancelled):
+            raise
+        except Exception as e:
+            record_error(e)
+            logger.warning(f"Streaming upload failed, falling back to a full download: {e}")
+
+    temp_dir = resume.temp_dir if resume and resume.temp_dir else job_dirs.create()
+    job_journal.set_temp_dir(job_id, temp_dir)
+    interrupted = False
+    try:
+        filename, info = await download_media(context, url, media_type, video_key, targets, temp_dir, info)
+        try:
+            return await upload_media(context, targets[0].chat_id, media_type, video_key, filename, info)
+        finally:
+            media_cache.release(filename)
+    except asyncio.CancelledError:
+        # Shutting down: the partial files let the next start resume
+        interrupted = True
+        raise
+    finally:
+        if not interrupted:
+            job_dirs.remove(temp_dir)
+
+async def lead_flight(
+    context,
+    user_id: int,
+    flight,
+    target: ProgressTarget,
+    url: str,
+    media_type: str,
+    video_key: Optional[str],
+    info: Optional[Dict],
+    resume: Optional[JournalEntry] = None,
+):
+    """Run the download a flight's targets are waiting for and report the outcome on target.
+
+    The job is journaled from here until it finishes or fails, including
+    while it is queued, so a restart can pick it up again.
+    """
+    if resume:
+        job_id = resume.job_id
+    else:
+        job_id = job_journal.add(
+            url, media_type, video_key, target.chat_id, target.message_id, target.use_caption, user_id
+        )
+    interrupted = False
+    was_queued = False
+
+    async def show_queue_position(position: int):
+        nonlocal was_queued
+        was_queued = True
+        for queued_target in list(flight.targets):
+            await edit_progress(
+                context, queued_target,
+                f"🕒 Queued — position {position}. Your download will start shortly..."
+            )
+
+    try:
+        async with download_scheduler.slot(user_id, on_position=show_queue_position):
+            if was_queued:
+                await edit_progress(context, target, "⏳ Starting download...")
+            result = await download_and_send(
+                context, url, media_type, video_key, flight.targets, job_id, info, resume
+            )
+        flight.finish(result)
+        update_user_stats(user_id)
+        await edit_progress(context, target, "✅ Download complete!")
+    except BaseException as e:
+        flight.fail(e)
+        if not isinstance(e, Exception):
+            # Shutting down: the journal entry lets the next start resume or re-queue the job
+            interrupted = isinstance(e, asyncio.CancelledError)
+            raise
+        record_error(e)
+        await edit_progress(context, target, describe_download_error(e))
+    finally:
+        download_flights.release(flight)
+        if not interrupted:
+            job_journal.remove(job_id)
+
+async def resume_job(context, job: JournalEntry):
+    """Finish a download a restart interrupted, reporting on its original progress message"""
+    target = ProgressTarget(job.chat_id, job.message_id, job.use_caption)
+    logger.info(f"Resuming {job.media_type} download of {job.url} (attempt {job.attempts})")
+    try:
+        await edit_progress(context, target, "🔄 The bot restarted — resuming your download...")
+    except Exception as e:
+        logger.warning(f"Could not re-attach to progress message {job.message_id}: {e}")
+    flight, leader = download_flights.join((job.video_key or job.url, job.media_type), target)
+    if not leader:
+        # Only one job per file is ever journaled, but never run two leaders for one flight
+        job_journal.remove(job.job_id)
+        job_dirs.remove(job.temp_dir)
+        flight.targets.remove(target)
+        return
+    await lead_flight(
+        context, job.user_id, flight, target, job.url, job.media_type, job.video_key,
+        await metadata_cache.get(job.video_key), resume=job,
+    )
+
+async def abandon_job(context, job: JournalEntry):
+    """Tell the user an interrupted download will not be resumed"""
+    target = ProgressTarget(job.chat_id, job.message_id, job.use_caption)
+    try:
+        await edit_progress(context, target, "❌ This download was interrupted too many times. Please send the link again")
+    except Exception as e:
+        logger.warning(f"Could not update progress message {job.message_id}: {e}")
+
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle button callbacks with improved error handling and responsiveness"""
     query = update.callback_query
@@ -391,6 +1239,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Handle cancel action
         if query.data == "cancel_download":
+            extraction_pool.cancel((query.message.chat_id, query.message.message_id))
             await query.edit_message_text("❌ Download canceled")
             return
         
@@ -400,18 +1249,33 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         
         # Handle playlist options
-        if query.data in ["playlist_all", "playlist_select"]:
+        if query.data.startswith("pl:"):
             await handle_playlist_option(query, context)
             return
         
         # Verify we have required data
-        url = context.user_data.get("url")
-        if not url:
+        session = None
+        if query.data.startswith("dl:"):
+            _, token, index = query.data.split(":", 2)
+            session = media_sessions.get(token)
+        if not session:
             await query.edit_message_text("❌ Session expired. Please send a new link")
             return
+        media_type = session.options[int(index)]
+        url = session.url
+        video_key = session.video_key
+
+        # Cached files are free; everything else is paid for before the card changes
+        if not await file_id_cache.get(video_key, media_type) and not media_cache.contains(
+            media_cache_key(video_key, download_opts(url, media_type, await metadata_cache.get(video_key)))
+        ):
+            wait = await charge(query.from_user.id, session.costs[int(index)])
+            if wait:
+                await query.message.reply_text(
+                    f"⏳ You're out of download credits. Please try again in {math.ceil(wait)} seconds"
+                )
+                return
 
-        media_type = query.data
-        context.user_data["media_type"] = media_type
         use_caption = bool(query.message.caption)
         
         # Show processing message
@@ -430,139 +1294,32 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.error(f"Message edit failed: {e}")
             return
 
-        # Generate random string for filename
-        random_str = generate_random_string()
-        
-        # Prepare download options
-        opts = base_yt_dlp_opts.copy()
-        opts["progress_hooks"] = [make_progress_hook(context, query.message.chat_id, progress_msg.message_id, use_caption)]
-        
-        # Set format based on selection
-        if media_type.startswith("audio_"):
-            quality = media_type.split("_")[1]
-            opts.update({
-                "format": "bestaudio/best",
-                "postprocessors": [{
-                    "key": "FFmpegExtractAudio",
-                    "preferredcodec": "mp3",
-                    "preferredquality": quality,
-                }],
-            })
-        elif media_type.startswith("format_"):
-            opts["format"] = media_type.split("_", 1)[1]
-
-        # Create a temporary directory for this download
-        with tempfile.TemporaryDirectory(prefix="ytdl_") as temp_dir:
-            # Update options with temp directory
-            temp_opts = opts.copy()
-            temp_opts["outtmpl"] = os.path.join(temp_dir, f"{random_str}.%(ext)s")
-            
+        target = ProgressTarget(query.message.chat_id, progress_msg.message_id, use_caption)
+
+        # Serve repeats straight from Telegram's storage when possible
+        full_info = await metadata_cache.get(video_key)
+        cached_info = full_info or session.media_info()
+        if await send_cached_media(context, target.chat_id, video_key, media_type, cached_info):
+            update_user_stats(query.from_user.id)
+            await edit_progress(context, target, "✅ Download complete!")
+            return
+
+        flight, leader = download_flights.join((video_key or url, media_type), target)
+        if not leader:
+            # Someone else is already fetching this exact file; wait for its file_id
+            await edit_progress(context, target, "⏳ Already downloading this for another user, joining...")
             try:
-                with yt_dlp.YoutubeDL(temp_opts) as ydl:
-                    # Download the file in a separate thread
-                    def download():
-                        try:
-                            ydl.download([url])
-                        except Exception as e:
-                            logger.error(f"Download thread error: {e}")
-                            raise
-
-                    await asyncio.get_event_loop().run_in_executor(None, download)
-                    
-                    # Get the actual filename
-                    info = context.user_data.get("info") or ydl.extract_info(url, download=False)
-                    # With this:
-                    downloaded_files = [f for f in os.listdir(temp_dir) if f.startswith(random_str)]
-                    if not downloaded_files:
-                        raise FileNotFoundError("No downloaded files found")
-                    filename = os.path.join(temp_dir, downloaded_files[0])
-                    
-                    # Verify file exists and has content
-                    # Add this after getting the filename:
-                    if not os.path.exists(filename):
-                        # Try with different extensions
-                        for ext in ['.mp4', '.mkv', '.webm', '.mp3']:
-                            alt_path = os.path.join(temp_dir, f"{random_str}{ext}")
-                            if os.path.exists(alt_path):
-                                filename = alt_path
-                                break
-                        else:
-                            raise FileNotFoundError(f"Could not find downloaded file at {filename}")
-                    
-                    file_size = os.path.getsize(filename)
-                    if file_size == 0:
-                        raise ValueError("Downloaded file is empty (0 bytes)")
-                    
-                    if file_size > MAX_FILE_SIZE:
-                        raise ValueError(f"📁 File size ({format_size(file_size)}) exceeds Telegram limit ({format_size(MAX_FILE_SIZE)})")
-
-                    # Update user stats
-                    update_user_stats(query.from_user.id)
-
-                    # Send the file with progress updates
-                    try:
-                        if media_type.startswith("audio_"):
-                            with open(filename, "rb") as f:
-                                await context.bot.send_audio(
-                                    chat_id=query.message.chat_id,
-                                    audio=f,
-                                    title=info.get('title', 'audio_file'),
-                                    performer=info.get('uploader', ''),
-                                    duration=info.get('duration'),
-                                    read_timeout=120,
-                                    write_timeout=120
-                                )
-                        else:
-                            with open(filename, "rb") as f:
-                                await context.bot.send_video(
-                                    chat_id=query.message.chat_id,
-                                    video=f,
-                                    supports_streaming=True,
-                                    duration=info.get('duration'),
-                                    width=info.get('width'),
-                                    height=info.get('height'),
-                                    caption=f"🎬 {info.get('title', 'video_file')}",
-                                    read_timeout=120,
-                                    write_timeout=120
-                                )
-
-                        if use_caption:
-                            await query.edit_message_caption("✅ Download complete!")
-                        else:
-                            await query.edit_message_text("✅ Download complete!")
-
-                    except Exception as upload_error:
-                        logger.error(f"File upload failed: {upload_error}")
-                        raise ValueError("Failed to upload file to Telegram")
-
-            except FileNotFoundError as e:
-                logger.error(f"File not found error: {e}")
-                error_msg = "❌ Error: The downloaded file could not be found. Please try again."
-                if use_caption:
-                    await query.edit_message_caption(error_msg)
-                else:
-                    await query.edit_message_text(error_msg)
-            except yt_dlp.utils.DownloadError as e:
-                logger.error(f"Download error: {e}")
-                error_msg = f"❌ Download failed: {str(e)[:200]}"
-                if use_caption:
-                    await query.edit_message_caption(error_msg)
-                else:
-                    await query.edit_message_text(error_msg)
+                kind, file_id = await flight.wait()
+                await send_media(context, target.chat_id, kind, file_id, cached_info)
+                update_user_stats(query.from_user.id)
+                await edit_progress(context, target, "✅ Download complete!")
             except Exception as e:
-                logger.error(f"Unexpected error: {e}", exc_info=True)
-                error_msg = f"❌ Error: {str(e)[:200]}"
-                if use_caption:
-                    await query.edit_message_caption(error_msg)
-                else:
-                    await query.edit_message_text(error_msg)
-            finally:
-                # Clean up downloaded file if it exists
-                if 'filename' in locals() and os.path.exists(filename):
-                    try:
-                        os.remove(filename)
-                    except Exception as e:
-                        logger.error(f"Error cleaning up file: {e}")
+                await edit_progress(context, target, describe_download_error(e))
+            return
+
+        await lead_flight(
+            context, query.from_user.id, flight, target, url, media_type, video_key, full_info
+        )
     except Exception as e:
         logger.error(f"Callback handler error: {e}", exc_info=True)
         try:
@@ -574,19 +1331,151 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.error(f"Fallback message send failed: {inner_e}")
 
             
+async def show_playlist_page(query, playlist: Dict, page: int, text: str):
+    """Render one page of the playlist selector, loading that page if needed"""
+    lookup_key = (query.message.chat_id, query.message.message_id)
+    entries = page_entries(await fetch_playlist_page(playlist["url"], page, lookup_key))
+    start = page * PLAYLIST_PAGE_SIZE
+    if playlist["count"]:
+        has_next = start + PLAYLIST_PAGE_SIZE < playlist["count"]
+    else:
+        has_next = len(entries) == PLAYLIST_PAGE_SIZE
+    playlist["page"] = page
+    await query.edit_message_text(
+        text,
+        reply_markup=selection_keyboard(playlist["token"], entries, start, playlist["selected"], page, has_next)
+    )
+
 async def handle_playlist_option(query, context):
-    """Handle playlist download options"""
-    playlist_info = context.user_data.get("playlist_info")
-    if not playlist_info:
+    """Handle playlist download options, the item selector and resumes"""
+    _, token, action, *args = query.data.split(":")
+    playlist = playlist_sessions.get(token)
+    if not playlist:
         await query.edit_message_text("❌ Playlist info not found")
         return
-    
-    if query.data == "playlist_all":
-        # Implement playlist download logic here
-        await query.edit_message_text("⏳ This feature is coming soon!")
+    select_text = f"🎬 Select up to {PLAYLIST_MAX_ITEMS} videos, then tap download:"
+
+    if action == "all":
+        lookup_key = (query.message.chat_id, query.message.message_id)
+        indexes = list(range(await playlist_length(playlist, lookup_key)))
+        await run_playlist(query, context, playlist, indexes)
+    elif action in ("select", "page"):
+        page = int(args[0]) if args else 0
+        await show_playlist_page(query, playlist, page, select_text)
+    elif action == "toggle":
+        index = int(args[0])
+        selected = playlist["selected"]
+        if index in selected:
+            selected.discard(index)
+        elif len(selected) < PLAYLIST_MAX_ITEMS:
+            selected.add(index)
+        await show_playlist_page(query, playlist, playlist["page"], select_text)
+    elif action == "go":
+        if not playlist["selected"]:
+            await show_playlist_page(query, playlist, playlist["page"], "⚠️ Select at least one video first:")
+            return
+        await run_playlist(query, context, playlist, sorted(playlist["selected"]))
+    elif action == "resume":
+        await run_playlist(query, context, playlist, playlist["pending"])
+
+async def run_playlist(query, context, playlist: Dict, indexes: List[int]):
+    """Download and upload playlist items with a bounded number in flight.
+
+    Items already delivered in this session are skipped, so a retry resumes
+    where the previous run stopped. Items previously sent to anyone are
+    re-sent by file_id without downloading.
+    """
+    if playlist["running"]:
+        # The status message of the running download already shows progress
+        return
+    playlist["running"] = True
+    playlist["pending"] = [i for i in indexes if i not in playlist["done"]]
+
+    user_id = query.from_user.id
+    status = ProgressTarget(query.message.chat_id, query.message.message_id, bool(query.message.caption))
+    lookup_key = (status.chat_id, status.message_id)
+    total = len(indexes)
+    failed: List[int] = []
+
+    async def fetch(index: int):
+        entry = await playlist_entry(playlist, index, lookup_key)
+        if not entry.url:
+            raise ValueError("Video is unavailable")
+        video_key = canonical_video_key(entry.url)
+        if await file_id_cache.get(video_key, PLAYLIST_MEDIA_TYPE):
+            return entry, video_key, None, None, None
+        if entry.duration and entry.duration > MAX_VIDEO_DURATION:
+            raise ValueError(f"Longer than {MAX_VIDEO_DURATION // 3600} hours")
+        info = await metadata_cache.get(video_key)
+        cached = media_cache.contains(media_cache_key(video_key, download_opts(entry.url, PLAYLIST_MEDIA_TYPE, info)))
+        # Playlist items run at the pace the user's credits allow
+        while not cached:
+            wait = await charge(user_id, download_cost(720))
+            if not wait:
+                break
+            await edit_progress(context, status, f"⏳ Out of download credits, continuing in {math.ceil(wait)} seconds...")
+            await asyncio.sleep(wait)
+        temp_dir = job_dirs.create()
+        try:
+            async with download_scheduler.slot(user_id):
+                filename, info = await download_media(
+                    context, entry.url, PLAYLIST_MEDIA_TYPE, video_key, [status], temp_dir, info
+                )
+        except BaseException:
+            job_dirs.remove(temp_dir)
+            raise
+        return entry, video_key, temp_dir, filename, info
+
+    def discard(result):
+        if isinstance(result, tuple) and result[2]:
+            media_cache.release(result[3])
+            job_dirs.remove(result[2])
+
+    async def deliver(index: int, result):
+        try:
+            if isinstance(result, Exception):
+                raise result
+            entry, video_key, temp_dir, filename, info = result
+            fallback_info = {"title": entry.title, "duration": entry.duration}
+            if filename is None and not await send_cached_media(
+                context, status.chat_id, video_key, PLAYLIST_MEDIA_TYPE,
+                await metadata_cache.get(video_key) or fallback_info
+            ):
+                # The cached file_id went stale; fetch the item after all
+                result = await fetch(index)
+                entry, video_key, temp_dir, filename, info = result
+            if filename is not None:
+                await upload_media(context, status.chat_id, PLAYLIST_MEDIA_TYPE, video_key, filename, info)
+            playlist["done"].add(index)
+            playlist["pending"].remove(index)
+            update_user_stats(user_id)
+        except Exception as e:
+            record_error(e)
+            logger.error(f"Playlist item {index + 1} failed: {e}")
+            failed.append(index)
+        finally:
+            discard(result)
+        sent = total - len(playlist["pending"])
+        await edit_progress(
+            context, status,
+            f"📼 Playlist: {sent}/{total} sent" + (f", {len(failed)} failed" if failed else "")
+        )
+
+    try:
+        await edit_progress(context, status, f"📼 Starting playlist download ({len(playlist['pending'])} videos)...")
+        await run_pipeline(list(playlist["pending"]), fetch, deliver, discard, prefetch=PLAYLIST_PREFETCH)
+    finally:
+        playlist["running"] = False
+
+    if playlist["pending"]:
+        await query.edit_message_text(
+            f"⚠️ Playlist finished with {len(playlist['pending'])} of {total} videos not sent.",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔁 Retry remaining", callback_data=f"pl:{playlist['token']}:resume")]
+            ])
+        )
     else:
-        # Implement playlist selection logic here
-        await query.edit_message_text("⏳ This feature is coming soon!")
+        await edit_progress(context, status, f"✅ Playlist complete! {total} videos sent.")
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /help command or help button"""
@@ -598,13 +1487,14 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "3. Wait for the download to complete\n\n"
         "<b>Features:</b>\n"
         "• Multiple video quality options\n"
-        "• High-quality MP3 audio extraction\n"
+        "• MP3 audio, or the original track without re-encoding\n"
         "• Fast downloads with progress tracking\n"
-        "• Support for playlists (coming soon)\n\n"
+        f"• Playlists: download all (up to {PLAYLIST_MAX_ITEMS}) or pick videos\n\n"
         "<b>Limitations:</b>\n"
         "• Max video length: 2 hours\n"
-        "• Max file size: 50MB (Telegram limit)\n"
-        "• Rate limit: 1 request every 30 seconds\n\n"
+        f"• Max file size: {format_size(MAX_FILE_SIZE)} (Telegram limit)\n"
+        f"• Rate limit: {FREE_TIER.capacity} credits, 1 back every {round(1 / FREE_TIER.rate)} seconds "
+        "(lookups cost 1, downloads 2-8, cached files are free)\n\n"
         "<b>Commands:</b>\n"
         "/start - Show welcome message\n"
         "/help - Show this help\n"
@@ -618,46 +1508,116 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show user download statistics"""
-    user_id = str(update.effective_user.id)
-    stats = user_stats.get(user_id, {"downloads": 0, "last_download": None})
+    downloads, last_download = await user_stats.get(update.effective_user.id)
+    tier = user_tier(update.effective_user.id)
+    if tier:
+        plan = f"{tier.name}, up to {tier.capacity} credits, 1 back every {round(1 / tier.rate)} seconds"
+    else:
+        plan = "admin, unlimited"
     
-    last_download = "Never" if not stats["last_download"] else stats["last_download"].strftime("%Y-%m-%d %H:%M:%S")
+    last_download = "Never" if not last_download else datetime.fromtimestamp(last_download).strftime("%Y-%m-%d %H:%M:%S")
     
     stats_text = (
         f"📊 <b>Your Download Statistics</b>\n\n"
-        f"📥 Total downloads: <b>{stats['downloads']}</b>\n"
+        f"📥 Total downloads: <b>{downloads}</b>\n"
         f"⏳ Last download: <b>{last_download}</b>\n\n"
-        f"🔄 Rate limit: 1 request every {RATE_LIMIT.seconds} seconds"
+        f"🔄 Plan: {plan}"
     )
     
     await update.message.reply_text(stats_text, parse_mode="HTML")
 
-async def cleanup_temp_files():
-    """Clean up temporary files older than 1 hour"""
+def current_load() -> Dict:
+    """Snapshot of the bot's load for the readiness probe"""
+    return {
+        **download_scheduler.stats(),
+        "extractions": extraction_pool.outstanding,
+        "temp_free_bytes": shutil.disk_usage(job_dirs.root).free,
+    }
+
+async def heartbeat_loop():
+    """Prove the event loop is responsive and publish load for /readyz"""
     while True:
         try:
-            now = time.time()
-            for filename in os.listdir(TEMP_DIR):
-                filepath = os.path.join(TEMP_DIR, filename)
-                if os.path.isfile(filepath):
-                    file_age = now - os.path.getmtime(filepath)
-                    if file_age > 3600:  # 1 hour
-                        try:
-                            os.remove(filepath)
-                            logger.info(f"Cleaned up temp file: {filename}")
-                        except Exception as e:
-                            logger.error(f"Error cleaning up {filename}: {e}")
+            load = current_load()
+            health.heartbeat(load)
+            QUEUE_DEPTH.set(load["queued"])
+            ACTIVE_JOBS.set(load["active_downloads"], stage="download")
+            ACTIVE_JOBS.set(load["active_postprocessing"], stage="postprocess")
+            ACTIVE_JOBS.set(load["extractions"], stage="extract")
+            MEDIA_CACHE_BYTES.set(media_cache.total_bytes)
         except Exception as e:
-            logger.error(f"Error in cleanup_temp_files: {e}")
-        
-        await asyncio.sleep(3600)  # Run once per hour
+            logger.error(f"Heartbeat error: {e}")
+            health.heartbeat()
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
 
-def main():
-    """Start the bot"""
-    # Start the temp file cleanup task
-    asyncio.get_event_loop().create_task(cleanup_temp_files())
+async def post_init(application: Application):
+    """Start background tasks once the application's event loop is running"""
+    health.configure_probes(
+        max_heartbeat_age=LIVENESS_MAX_AGE,
+        max_load={
+            "queued": READY_MAX_QUEUE,
+            "active_downloads": READY_MAX_ACTIVE_DOWNLOADS,
+            "extractions": EXTRACT_WORKERS + EXTRACT_QUEUE_SIZE - 1,
+        },
+        min_load={"temp_free_bytes": READY_MIN_FREE_TEMP_BYTES},
+    )
+    # Nothing is running yet, so every job directory on disk was left by a previous process;
+    # those of journaled downloads are kept and the downloads resumed, or re-queued if they never started
+    interrupted, dropped = job_journal.take_interrupted(JOB_RESUME_ATTEMPTS)
+    job_dirs.reclaim_orphans(keep=[job.temp_dir for job in interrupted if job.temp_dir])
+    context = application.context_types.context(application)
+    for job in interrupted:
+        application.create_task(resume_job(context, job))
+    for job in dropped:
+        application.create_task(abandon_job(context, job))
+    application.create_task(heartbeat_loop())
+    application.create_task(job_dirs.run())
+    application.create_task(user_stats.run())
+
+async def post_shutdown(application: Application):
+    """Write out buffered stats and release the rate limit backend"""
+    await user_stats.flush()
+    await limits_backend.close()
+    await http_client.aclose()
 
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+async def run_webhook(application: Application):
+    """Serve Telegram webhooks and the health route from one async HTTP server"""
+    async def on_update(data: dict):
+        await application.update_queue.put(Update.de_json(data, application.bot))
+
+    server = WebhookServer(WEBHOOK_PATH, on_update, secret_token=WEBHOOK_SECRET)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with application:
+        await server.start()
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        await application.post_init(application)
+        await application.start()
+        logger.info(f"Receiving updates via webhook at {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+        try:
+            await stop.wait()
+        finally:
+            await server.stop()
+            await application.stop()
+            await application.post_shutdown(application)
+
+def build_application() -> Application:
+    """The Application with its Bot API server settings and handlers"""
+    # Handle updates concurrently so a slow lookup or download never blocks other users
+    builder = Application.builder().token(TELEGRAM_BOT_TOKEN).concurrent_updates(True)
+    builder = builder.post_init(post_init).post_shutdown(post_shutdown)
+    if BOT_API_BASE_URL:
+        builder = builder.base_url(BOT_API_BASE_URL).local_mode(BOT_API_LOCAL_MODE)
+        builder = builder.base_file_url(BOT_API_BASE_FILE_URL or BOT_API_BASE_URL.replace("/bot", "/file/bot"))
+        logger.info(f"Using Bot API server at {BOT_API_BASE_URL} (local mode: {BOT_API_LOCAL_MODE})")
+    application = builder.build()
 
     # Command handlers
     application.add_handler(CommandHandler("start", start))
@@ -669,9 +1629,31 @@ def main():
     
     # Callback handlers
     application.add_handler(CallbackQueryHandler(handle_callback))
+    return application
+
+def main():
+    """Start the bot"""
+    application = build_application()
 
     # Start the bot
-    application.run_polling()
+    try:
+        if BOT_MODE == "webhook":
+            if not WEBHOOK_URL:
+                raise RuntimeError("WEBHOOK_URL must be set when BOT_MODE=webhook")
+            asyncio.run(run_webhook(application))
+        else:
+            # Health check server for the platform's probes
+            health_thread = threading.Thread(target=run_health_server)
+            health_thread.daemon = True
+            health_thread.start()
+            application.run_polling()
+    finally:
+        extraction_pool.shutdown()
+        metadata_cache.close()
+        file_id_cache.close()
+        job_dirs.close()
+        job_journal.close()
+        download_scheduler.shutdown()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,136 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Sequence, Tuple
+
+# Prometheus text exposition without extra dependencies
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+THROUGHPUT_BUCKETS = tuple(kb * 1024 for kb in (64, 256, 512, 1024, 2048, 5120, 10240, 25600, 51200, 102400))
+
+_registry: List["_Metric"] = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str):
+        super().__init__(name, documentation)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{_format_labels(k)} {v}" for k, v in self._values.items()]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str):
+        super().__init__(name, documentation)
+        self._values: Dict[Tuple, float] = {}
+
+    def set(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = value
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{_format_labels(k)} {v}" for k, v in self._values.items()]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            # Per-bucket counts plus the +Inf bucket, then the running sum
+            entry = self._values.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0])
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall-clock duration of the with block"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def _samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(float(bound))
+                    lines.append(f"{self.name}_bucket{_format_labels(key + (('le', le),))} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+
+def render() -> str:
+    """All registered metrics in Prometheus text format"""
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+EXTRACT_SECONDS = Histogram("ytbot_extract_seconds", "Time spent in yt-dlp extract_info on cache misses")
+DOWNLOAD_SECONDS = Histogram("ytbot_download_seconds", "Time spent downloading and post-processing a file")
+DOWNLOAD_THROUGHPUT = Histogram(
+    "ytbot_download_throughput_bytes_per_second", "Bytes per second of completed downloads", THROUGHPUT_BUCKETS
+)
+POSTPROCESS_SECONDS = Histogram("ytbot_postprocess_seconds", "Time spent in ffmpeg post-processors")
+UPLOAD_SECONDS = Histogram("ytbot_upload_seconds", "Time spent sending a file to Telegram")
+CACHE_REQUESTS = Counter("ytbot_cache_requests_total", "Cache lookups by cache and result")
+ERRORS = Counter("ytbot_errors_total", "Failed requests by error type")
+AUDIO_JOBS = Counter("ytbot_audio_jobs_total", "Audio downloads by whether the track was copied or encoded")
+AUDIO_CPU_SECONDS_SAVED = Counter(
+    "ytbot_audio_cpu_seconds_saved_total", "Estimated ffmpeg seconds saved by copying audio instead of encoding MP3"
+)
+QUEUE_DEPTH = Gauge("ytbot_queue_depth", "Downloads waiting for a slot")
+ACTIVE_JOBS = Gauge("ytbot_active_jobs", "Jobs currently running by stage")
+MEDIA_CACHE_BYTES = Gauge("ytbot_media_cache_bytes", "Bytes of downloaded files held in the media cache")
@@ -0,0 +1,115 @@
+import asyncio
+import logging
+from collections import namedtuple
+from typing import Awaitable, Callable, Dict, Iterable, List, Set
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+logger = logging.getLogger(__name__)
+
+# The few fields of a flat playlist entry the bot needs
+PlaylistEntry = namedtuple("PlaylistEntry", ["video_id", "url", "title", "duration"])
+
+
+def flat_entries(info: Dict) -> List[PlaylistEntry]:
+    """Compact entries from a playlist extracted with extract_flat.
+
+    Entries keep their position in the playlist; ones that cannot be
+    downloaded (deleted or private videos) get a url of None.
+    """
+    entries = []
+    for e in info.get("entries") or []:
+        e = e or {}
+        entries.append(PlaylistEntry(
+            e.get("id"),
+            e.get("url") or e.get("webpage_url"),
+            e.get("title") or e.get("id") or "Unavailable",
+            e.get("duration"),
+        ))
+    return entries
+
+
+def playlist_page(info: Dict) -> Dict:
+    """Cacheable summary of one page of a flat playlist extraction"""
+    return {
+        "title": info.get("title") or "Untitled",
+        "count": info.get("playlist_count"),
+        "entries": [list(e) for e in flat_entries(info)],
+    }
+
+
+def page_entries(page: Dict) -> List[PlaylistEntry]:
+    return [PlaylistEntry(*e) for e in page["entries"]]
+
+
+def selection_keyboard(token: str, entries: List[PlaylistEntry], start: int, selected: Set[int], page: int, has_next: bool) -> InlineKeyboardMarkup:
+    """One page of toggleable entries, numbered from start, with paging and download buttons"""
+    rows = []
+    for i, entry in enumerate(entries, start):
+        mark = "✅" if i in selected else "⬜"
+        rows.append([InlineKeyboardButton(f"{mark} {i + 1}. {entry.title[:40]}", callback_data=f"pl:{token}:toggle:{i}")])
+
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"pl:{token}:page:{page - 1}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"pl:{token}:page:{page + 1}"))
+    if nav:
+        rows.append(nav)
+
+    rows.append([
+        InlineKeyboardButton(f"⬇️ Download selected ({len(selected)})", callback_data=f"pl:{token}:go"),
+        InlineKeyboardButton("❌ Cancel", callback_data="cancel_download"),
+    ])
+    return InlineKeyboardMarkup(rows)
+
+
+async def run_pipeline(
+    items: Iterable,
+    fetch: Callable[..., Awaitable],
+    deliver: Callable[..., Awaitable],
+    discard: Callable,
+    prefetch: int = 1,
+):
+    """Fetch items in order while delivering earlier ones.
+
+    At most `prefetch` fetched results wait for delivery, so the upload of
+    item N overlaps the download of item N+1 without the pipeline racing
+    ahead of Telegram. A failed fetch is passed to deliver as the exception
+    instead of a result. Results that are never delivered are discarded.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=prefetch)
+    done = object()
+
+    async def producer():
+        for item in items:
+            try:
+                result = await fetch(item)
+            except Exception as e:
+                result = e
+            try:
+                await queue.put((item, result))
+            except asyncio.CancelledError:
+                discard(result)
+                raise
+        await queue.put(done)
+
+    producer_task = asyncio.create_task(producer())
+    try:
+        while True:
+            entry = await queue.get()
+            if entry is done:
+                break
+            await deliver(*entry)
+    finally:
+        producer_task.cancel()
+        try:
+            await producer_task
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Playlist producer failed: {e}")
+        while not queue.empty():
+            entry = queue.get_nowait()
+            if entry is not done:
+                discard(entry[1])
@@ -0,0 +1,100 @@
+import logging
+import os
+import shlex
+import shutil
+from typing import Dict, List, Optional
+
+from metrics import AUDIO_CPU_SECONDS_SAVED, AUDIO_JOBS
+
+logger = logging.getLogger(__name__)
+
+# libmp3lame compression_level (lame's -q): lower is slower and slightly better
+PRESETS = {"fast": 7, "balanced": 5, "quality": 2}
+
+
+def cpu_count() -> int:
+    """CPUs this process may run on, which can be fewer than the host has"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def auto_preset(threads_per_job: int) -> str:
+    """Pick an encoder preset from the CPU each ffmpeg job gets, so no per-host tuning is needed"""
+    if threads_per_job >= 4:
+        return "quality"
+    if threads_per_job >= 2:
+        return "balanced"
+    return "fast"
+
+
+def postprocessor_args(threads: int, preset: str) -> Dict[str, List[str]]:
+    """yt-dlp postprocessor_args capping ffmpeg's threads and setting the MP3 encoder preset"""
+    return {
+        "ffmpeg": ["-threads", str(threads)],
+        "extractaudio": ["-compression_level", str(PRESETS[preset])],
+    }
+
+
+def ffmpeg_wrapper_dir(path: str, niceness: int, cpus: Optional[str]) -> Optional[str]:
+    """Write ffmpeg and ffprobe wrappers that run the real binaries niced and pinned to cpus.
+
+    cpus is a taskset CPU list such as "2-7". Returns the directory to use
+    as yt-dlp's ffmpeg_location, or None when there is nothing to apply or
+    the wrappers cannot be built (no POSIX shell, nice or ffmpeg).
+    """
+    if os.name != "posix" or (not niceness and not cpus):
+        return None
+    prefix = []
+    if niceness:
+        if shutil.which("nice"):
+            prefix += ["nice", "-n", str(niceness)]
+        else:
+            logger.warning("nice not found; ffmpeg runs at normal priority")
+    if cpus:
+        if shutil.which("taskset"):
+            prefix += ["taskset", "-c", cpus]
+        else:
+            logger.warning("taskset not found; ffmpeg CPU affinity is not applied")
+    if not prefix:
+        return None
+
+    programs = {program: shutil.which(program) for program in ("ffmpeg", "ffprobe")}
+    missing = [program for program, real in programs.items() if not real]
+    if missing:
+        logger.warning(f"{', '.join(missing)} not found; ffmpeg runs without priority controls")
+        return None
+
+    os.makedirs(path, exist_ok=True)
+    for program, real in programs.items():
+        script = os.path.join(path, program)
+        with open(script, "w") as f:
+            f.write("#!/bin/sh\nexec " + " ".join(shlex.quote(arg) for arg in prefix + [real]) + ' "$@"\n')
+        os.chmod(script, 0o755)
+    return path
+
+
+class AudioEncodeCost:
+    """Running estimate of ffmpeg seconds per second of audio for MP3 encodes.
+
+    Transcoded jobs refine the estimate; copied tracks are credited with
+    the encoding time the estimate says they avoided.
+    """
+
+    def __init__(self, seconds_per_audio_second: float, smoothing: float = 0.1):
+        self.seconds_per_audio_second = seconds_per_audio_second
+        self.smoothing = smoothing
+
+    def record(self, copied: bool, ffmpeg_seconds: float, duration: Optional[float]) -> float:
+        """Count an audio job and return the ffmpeg seconds it saved"""
+        if copied:
+            AUDIO_JOBS.inc(mode="copy")
+            if not duration:
+                return 0.0
+            saved = max(0.0, duration * self.seconds_per_audio_second - ffmpeg_seconds)
+            AUDIO_CPU_SECONDS_SAVED.inc(saved)
+            return saved
+        AUDIO_JOBS.inc(mode="transcode")
+        if duration and ffmpeg_seconds:
+            self.seconds_per_audio_second += self.smoothing * (ffmpeg_seconds / duration - self.seconds_per_audio_second)
+        return 0.0
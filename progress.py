@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import threading
+import time
+from datetime import timedelta
+from typing import Awaitable, Callable, Iterable, Optional
+
+from telegram.error import BadRequest, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+
+def _retry_delay(error: RetryAfter) -> float:
+    delay = error.retry_after
+    if isinstance(delay, timedelta):
+        return delay.total_seconds()
+    return float(delay)
+
+
+class ProgressPump:
+    """Latest-value-wins channel from a download thread to message edits.
+
+    Download threads call publish() as often as they like; it only stores
+    the newest text and never waits on the network. One asyncio task per
+    job applies the newest text at most once every min_interval seconds and
+    backs off when Telegram answers with RetryAfter.
+    """
+
+    def __init__(
+        self,
+        targets: Callable[[], Iterable],
+        edit: Callable[..., Awaitable],
+        min_interval: float = 3.0,
+    ):
+        self.targets = targets
+        self.edit = edit
+        self.min_interval = min_interval
+        self._loop = asyncio.get_running_loop()
+        self._event = asyncio.Event()
+        self._lock = threading.Lock()
+        self._latest: Optional[str] = None
+        self._signalled = False
+        self._last_text: Optional[str] = None
+        self._next_edit = 0.0
+        self._task = self._loop.create_task(self._run())
+
+    def publish(self, text: str):
+        """Record the newest progress text; safe to call from any thread"""
+        with self._lock:
+            self._latest = text
+            if self._signalled:
+                return
+            self._signalled = True
+        self._loop.call_soon_threadsafe(self._event.set)
+
+    def _take(self) -> Optional[str]:
+        with self._lock:
+            text, self._latest = self._latest, None
+            self._signalled = False
+            return text
+
+    async def _run(self):
+        while True:
+            await self._event.wait()
+            delay = self._next_edit - time.monotonic()
+            if delay > 0:
+                # Let further updates pile up; only the newest one is sent
+                await asyncio.sleep(delay)
+            self._event.clear()
+            text = self._take()
+            if text is not None:
+                await self._apply(text)
+
+    async def _apply(self, text: str):
+        if text == self._last_text:
+            return
+        for target in list(self.targets()):
+            while True:
+                try:
+                    await self.edit(target, text)
+                    break
+                except RetryAfter as e:
+                    delay = _retry_delay(e)
+                    logger.warning(f"Progress edits rate limited, retrying in {delay}s")
+                    self._next_edit = time.monotonic() + delay
+                    await asyncio.sleep(delay)
+                except BadRequest as e:
+                    # Usually "message is not modified" or a deleted message
+                    logger.debug(f"Progress edit skipped: {e}")
+                    break
+                except Exception as e:
+                    logger.error(f"Progress edit failed: {e}")
+                    break
+        self._last_text = text
+        self._next_edit = max(self._next_edit, time.monotonic() + self.min_interval)
+
+    async def close(self, final_text: Optional[str] = None):
+        """Stop the pump, then show final_text right away if given"""
+        if not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if final_text is not None:
+            await self._apply(final_text)
@@ -0,0 +1,393 @@
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import unquote, urlparse
+
+from sessions import BoundedStore
+
+logger = logging.getLogger(__name__)
+
+# A batch of stats maps user_id -> (downloads to add, latest download timestamp)
+StatsBatch = Dict[int, Tuple[int, float]]
+
+# A user's credit bucket: up to capacity credits, refilled at rate credits per second
+Tier = namedtuple("Tier", ["name", "capacity", "rate"])
+
+# Credits charged per action; anything served from a cache costs nothing
+LOOKUP_COST = 1
+AUDIO_COST = 2
+
+
+def download_cost(height: Optional[int]) -> int:
+    """Credits for a video download, scaled by resolution"""
+    if not height:
+        return 3
+    if height >= 1080:
+        return 8
+    if height >= 720:
+        return 5
+    return 3
+
+
+class QuotaExceeded(Exception):
+    """Raised when a shared budget cannot cover a job in time"""
+
+
+def consume(
+    tokens: Optional[float], updated: Optional[float], now: float, cost: float, capacity: float, rate: float
+) -> Tuple[bool, float, float]:
+    """Refill a token bucket up to now and try to take cost tokens from it.
+
+    A bucket with no stored state starts full. Returns (allowed, seconds
+    until cost tokens are available, tokens left in the bucket).
+    """
+    if tokens is None or updated is None:
+        tokens = capacity
+    else:
+        tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+    if tokens >= cost:
+        return True, 0.0, tokens - cost
+    return False, (cost - tokens) / rate, tokens
+
+
+class MemoryBackend:
+    """Per-process buckets and stats; they reset on restart and are not shared between replicas"""
+
+    def __init__(self, bucket_ttl: float = 86400, stats_ttl: float = 30 * 86400, max_entries: int = 200000):
+        # A bucket untouched for longer than its refill time is full again, so expiring it is harmless
+        self._buckets = BoundedStore(ttl=bucket_ttl, max_entries=max_entries)
+        self._stats = BoundedStore(ttl=stats_ttl, max_entries=max_entries)
+
+    async def take(self, key: str, cost: float, capacity: float, rate: float) -> Tuple[bool, float]:
+        now = time.time()
+        tokens, updated = self._buckets.get(key, (None, None))
+        allowed, retry_after, tokens = consume(tokens, updated, now, cost, capacity, rate)
+        self._buckets.set(key, (tokens, now))
+        return allowed, retry_after
+
+    async def add_stats(self, batch: StatsBatch):
+        for user_id, (downloads, last_download) in batch.items():
+            total, _ = self._stats.get(user_id, (0, None))
+            self._stats.set(user_id, (total + downloads, last_download))
+
+    async def get_stats(self, user_id: int) -> Tuple[int, Optional[float]]:
+        return self._stats.get(user_id, (0, None))
+
+    async def close(self):
+        pass
+
+
+class SQLiteBackend:
+    """Buckets and stats in an SQLite file in WAL mode.
+
+    State survives restarts and is shared by every process on the host that
+    opens the same file. Bucket updates run in BEGIN IMMEDIATE transactions,
+    so concurrent processes cannot both spend the same tokens. Queries run
+    on a dedicated thread, so waiting on another process's write lock never
+    blocks the event loop.
+    """
+
+    def __init__(self, path: str, busy_timeout: float = 5.0):
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-limits")
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=busy_timeout, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS buckets ("
+            "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS user_stats ("
+            "user_id INTEGER PRIMARY KEY, downloads INTEGER NOT NULL, last_download REAL)"
+        )
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def take(self, key: str, cost: float, capacity: float, rate: float) -> Tuple[bool, float]:
+        return await self._run(self._take, key, cost, capacity, rate)
+
+    async def add_stats(self, batch: StatsBatch):
+        await self._run(self._add_stats, batch)
+
+    async def get_stats(self, user_id: int) -> Tuple[int, Optional[float]]:
+        return await self._run(self._get_stats, user_id)
+
+    async def close(self):
+        await self._run(self._close)
+        self._executor.shutdown(wait=False)
+
+    def _take(self, key: str, cost: float, capacity: float, rate: float) -> Tuple[bool, float]:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                now = time.time()
+                allowed, retry_after, tokens = consume(*(row or (None, None)), now, cost, capacity, rate)
+                self._db.execute(
+                    "INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                    (key, tokens, now),
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return allowed, retry_after
+
+    def _add_stats(self, batch: StatsBatch):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.executemany(
+                    "INSERT INTO user_stats (user_id, downloads, last_download) VALUES (?, ?, ?) "
+                    "ON CONFLICT (user_id) DO UPDATE SET downloads = downloads + excluded.downloads, "
+                    "last_download = MAX(COALESCE(last_download, 0), excluded.last_download)",
+                    [(user_id, downloads, last) for user_id, (downloads, last) in batch.items()],
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def _get_stats(self, user_id: int) -> Tuple[int, Optional[float]]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT downloads, last_download FROM user_stats WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return tuple(row) if row else (0, None)
+
+    def _close(self):
+        with self._lock:
+            self._db.close()
+
+
+class RedisError(Exception):
+    """Error reply from a Redis server"""
+
+
+class RedisClient:
+    """Minimal asyncio client for the Redis protocol (RESP2).
+
+    One connection is shared and commands are serialised by a lock, which
+    is plenty for a handful of small commands per bot update. The
+    connection is dropped after any failure and reopened on the next call.
+    """
+
+    def __init__(self, url: str, timeout: float = 5.0):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.username = unquote(parsed.username) if parsed.username else None
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _encode(command) -> bytes:
+        parts = [b"*%d\r\n" % len(command)]
+        for arg in command:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(parts)
+
+    async def _read_reply(self):
+        line = await self._reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Redis connection closed")
+        prefix, rest = line[:1], line[1:-2]
+        if prefix == b"+":
+            return rest.decode()
+        if prefix == b"-":
+            # Returned rather than raised so the rest of a pipeline is still read
+            return RedisError(rest.decode())
+        if prefix == b":":
+            return int(rest)
+        if prefix == b"$":
+            length = int(rest)
+            if length < 0:
+                return None
+            return (await self._reader.readexactly(length + 2))[:-2]
+        if prefix == b"*":
+            length = int(rest)
+            if length < 0:
+                return None
+            return [await self._read_reply() for _ in range(length)]
+        raise ConnectionError(f"Unexpected Redis reply {line!r}")
+
+    async def _roundtrip(self, commands) -> List:
+        self._writer.write(b"".join(self._encode(c) for c in commands))
+        await self._writer.drain()
+        return [await self._read_reply() for _ in commands]
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.username, self.password) if self.username else ("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+        if setup:
+            for reply in await self._roundtrip(setup):
+                if isinstance(reply, RedisError):
+                    raise reply
+
+    def _drop(self):
+        if self._writer:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def pipeline(self, *commands) -> List:
+        """Send commands in one round trip and return their replies"""
+        async with self._lock:
+            try:
+                if self._writer is None:
+                    await asyncio.wait_for(self._connect(), self.timeout)
+                replies = await asyncio.wait_for(self._roundtrip(commands), self.timeout)
+            except BaseException:
+                # The connection may hold unread replies; start over next time
+                self._drop()
+                raise
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    async def execute(self, *args):
+        return (await self.pipeline(args))[0]
+
+    async def eval_script(self, script: str, keys: List[str], args: List) -> object:
+        """Run a Lua script by its SHA1, loading it on first use"""
+        sha = hashlib.sha1(script.encode()).hexdigest()
+        try:
+            return await self.execute("EVALSHA", sha, len(keys), *keys, *args)
+        except RedisError as e:
+            if not str(e).startswith("NOSCRIPT"):
+                raise
+            return await self.execute("EVAL", script, len(keys), *keys, *args)
+
+    async def close(self):
+        async with self._lock:
+            self._drop()
+
+
+# Same arithmetic as consume(), run atomically inside Redis on the server's clock
+TAKE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1])
+if tokens == nil then
+    tokens = capacity
+else
+    tokens = math.min(capacity, tokens + math.max(0, now - tonumber(state[2])) * rate)
+end
+local allowed = 0
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry_after = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+return {allowed, tostring(retry_after)}
+"""
+
+
+class RedisBackend:
+    """Buckets and stats in Redis, shared by every replica using the same server"""
+
+    def __init__(self, url: str, prefix: str = "ytbot:"):
+        self.client = RedisClient(url)
+        self.prefix = prefix
+
+    async def take(self, key: str, cost: float, capacity: float, rate: float) -> Tuple[bool, float]:
+        allowed, retry_after = await self.client.eval_script(
+            TAKE_SCRIPT, [f"{self.prefix}bucket:{key}"], [capacity, rate, cost]
+        )
+        return bool(allowed), float(retry_after)
+
+    async def add_stats(self, batch: StatsBatch):
+        commands = []
+        for user_id, (downloads, last_download) in batch.items():
+            key = f"{self.prefix}stats:{user_id}"
+            commands.append(("HINCRBY", key, "downloads", downloads))
+            commands.append(("HSET", key, "last_download", repr(last_download)))
+        if commands:
+            await self.client.pipeline(*commands)
+
+    async def get_stats(self, user_id: int) -> Tuple[int, Optional[float]]:
+        downloads, last_download = await self.client.execute(
+            "HMGET", f"{self.prefix}stats:{user_id}", "downloads", "last_download"
+        )
+        return int(downloads or 0), float(last_download) if last_download else None
+
+    async def close(self):
+        await self.client.close()
+
+
+def create_backend(kind: str, sqlite_path: str, redis_url: str):
+    """Build the rate-limit and stats backend named by kind"""
+    if kind == "memory":
+        return MemoryBackend()
+    if kind == "sqlite":
+        return SQLiteBackend(sqlite_path)
+    if kind == "redis":
+        return RedisBackend(redis_url)
+    raise ValueError(f"Unknown rate limit backend {kind!r} (expected memory, sqlite or redis)")
+
+
+class StatsRecorder:
+    """Buffers download counts in memory and writes them to a backend in batches"""
+
+    def __init__(self, backend, flush_interval: float = 5.0):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self._pending: StatsBatch = {}
+
+    def record(self, user_id: int, when: Optional[float] = None):
+        downloads, _ = self._pending.get(user_id, (0, 0.0))
+        self._pending[user_id] = (downloads + 1, when or time.time())
+
+    async def get(self, user_id: int) -> Tuple[int, Optional[float]]:
+        """Stored stats plus downloads not flushed yet"""
+        downloads, last_download = await self.backend.get_stats(user_id)
+        pending, pending_last = self._pending.get(user_id, (0, None))
+        if pending:
+            downloads += pending
+            last_download = max(last_download or 0, pending_last)
+        return downloads, last_download
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        try:
+            await self.backend.add_stats(batch)
+        except Exception as e:
+            logger.error(f"Stats flush failed, keeping {len(batch)} users for the next one: {e}")
+            for user_id, (downloads, last_download) in batch.items():
+                pending, pending_last = self._pending.get(user_id, (0, 0.0))
+                self._pending[user_id] = (downloads + pending, max(last_download, pending_last))
+
+    async def run(self):
+        """Flush every flush_interval seconds until cancelled"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
@@ -0,0 +1,79 @@
+import secrets
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, Optional
+
+
+def new_token() -> str:
+    """Short random session key, safe to embed in callback_data"""
+    return secrets.token_urlsafe(6)
+
+
+class BoundedStore:
+    """Mapping with a per-entry TTL and a global entry cap.
+
+    Entries are kept in write order, so the oldest write is both the next
+    to expire and the first to be evicted when the store is full. Expired
+    entries are dropped lazily on reads and writes.
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return default
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        now = time.monotonic()
+        self._entries[key] = (now + self.ttl, value)
+        self._entries.move_to_end(key)
+        self._prune(now)
+
+    def _prune(self, now: float):
+        while self._entries:
+            expires_at, _ = next(iter(self._entries.values()))
+            if expires_at >= now and len(self._entries) <= self.max_entries:
+                break
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class MediaSession:
+    """The few fields a video card's buttons need, instead of the whole info dict"""
+
+    __slots__ = ("url", "video_key", "title", "uploader", "duration", "width", "height", "options", "costs")
+
+    def __init__(self, url: str, video_key: Optional[str], info: Dict, options: Iterable[str], costs: Iterable[int]):
+        self.url = url
+        self.video_key = video_key
+        self.title = info.get("title")
+        self.uploader = info.get("uploader")
+        self.duration = info.get("duration")
+        self.width = info.get("width")
+        self.height = info.get("height")
+        # Media types offered on the card; buttons refer to them by index
+        self.options = tuple(options)
+        # Rate limit credits each option costs when it is not served from cache
+        self.costs = tuple(costs)
+
+    def media_info(self) -> Dict:
+        """The fields send_media reads, in info dict form"""
+        fields = {
+            "title": self.title,
+            "uploader": self.uploader,
+            "duration": self.duration,
+            "width": self.width,
+            "height": self.height,
+        }
+        return {k: v for k, v in fields.items() if v is not None}
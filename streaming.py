@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import re
+import secrets
+from typing import AsyncIterator, Callable, Dict, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 256 * 1024
+
+
+class StreamError(Exception):
+    """Raised when a source cannot be streamed into Telegram as-is"""
+
+
+async def source_size(client: httpx.AsyncClient, url: str, headers: Dict) -> Optional[int]:
+    """Exact size of the resource at url, or None if the server does not say"""
+    async with client.stream("GET", url, headers={**headers, "Range": "bytes=0-0"}) as response:
+        response.raise_for_status()
+        if response.status_code == 206:
+            match = re.search(r"/(\d+)$", response.headers.get("content-range", ""))
+            return int(match.group(1)) if match else None
+        length = response.headers.get("content-length")
+        return int(length) if length else None
+
+
+async def ranged_chunks(
+    client: httpx.AsyncClient, url: str, headers: Dict, size: int, range_size: int
+) -> AsyncIterator[bytes]:
+    """Read url in Range requests of range_size bytes.
+
+    Like yt-dlp's http_chunk_size, this keeps hosts that throttle long
+    single requests (YouTube in particular) at full speed.
+    """
+    for start in range(0, size, range_size):
+        end = min(start + range_size, size) - 1
+        async with client.stream("GET", url, headers={**headers, "Range": f"bytes={start}-{end}"}) as response:
+            response.raise_for_status()
+            if response.status_code != 206 and size > range_size:
+                raise StreamError("Source ignores Range requests")
+            async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                yield chunk
+
+
+def _form_field(boundary: str, name: str, value) -> bytes:
+    return (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+        f"{value}\r\n"
+    ).encode()
+
+
+async def stream_upload(
+    client: httpx.AsyncClient,
+    api_url: str,
+    fields: Dict,
+    file_field: str,
+    filename: str,
+    content_type: str,
+    source: AsyncIterator[bytes],
+    size: int,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+    buffer_chunks: int = 16,
+) -> Dict:
+    """POST a multipart Bot API request whose file part is read from source as it arrives.
+
+    Source chunks pass through a queue of at most buffer_chunks entries, so
+    a fast download runs ahead of the upload by a fixed amount of memory
+    instead of a temp file. The Content-Length is sent up front, so the
+    source must produce exactly size bytes; anything else aborts the upload.
+    Returns the "result" of the Bot API response.
+    """
+    boundary = secrets.token_hex(16)
+    head = b"".join(_form_field(boundary, name, value) for name, value in fields.items() if value is not None)
+    head += (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+
+    queue: asyncio.Queue = asyncio.Queue(maxsize=buffer_chunks)
+
+    async def produce():
+        try:
+            async for chunk in source:
+                await queue.put(chunk)
+            await queue.put(None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await queue.put(e)
+
+    async def body():
+        yield head
+        sent = 0
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            sent += len(chunk)
+            if sent > size:
+                raise StreamError(f"Source sent more than the expected {size} bytes")
+            if on_progress:
+                on_progress(sent, size)
+            yield chunk
+        if sent != size:
+            raise StreamError(f"Source ended after {sent} of {size} bytes")
+        yield tail
+
+    producer = asyncio.create_task(produce())
+    try:
+        response = await client.post(
+            api_url,
+            content=body(),
+            headers={
+                "Content-Type": f"multipart/form-data; boundary={boundary}",
+                "Content-Length": str(len(head) + size + len(tail)),
+            },
+        )
+    finally:
+        producer.cancel()
+        try:
+            await producer
+        except asyncio.CancelledError:
+            pass
+
+    data = response.json()
+    if not data.get("ok"):
+        raise StreamError(f"Telegram rejected the upload: {data.get('description')}")
+    return data["result"]
@@ -0,0 +1,163 @@
+import asyncio
+import heapq
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class JobDirs:
+    """Per-job scratch directories under root, tracked in an SQLite manifest.
+
+    Every directory is recorded before it is used, so one left behind by a
+    killed process is found and removed by reclaim_orphans() at the next
+    start. Directories a job forgets to remove are reclaimed when they
+    expire: run() sleeps until the earliest expiry in a min-heap instead of
+    scanning root.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        manifest_path: str,
+        max_age: float = 3 * 3600,
+        min_free_bytes: int = 0,
+        on_low_space: Optional[Callable[[int], int]] = None,
+        check_interval: float = 60,
+    ):
+        self.root = root
+        self.max_age = max_age
+        # Below this many free bytes on root's filesystem, on_low_space(bytes short) is asked to free space
+        self.min_free_bytes = min_free_bytes
+        self.on_low_space = on_low_space
+        self.check_interval = check_interval
+        self.reclaimed = 0
+        self._expiry: Dict[str, float] = {}
+        self._heap: List[Tuple[float, str]] = []
+        self._wakeup: Optional[asyncio.Event] = None
+
+        os.makedirs(root, exist_ok=True)
+        os.makedirs(os.path.dirname(manifest_path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(manifest_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS job_dirs (path TEXT PRIMARY KEY, created_at REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def reclaim_orphans(self, keep: Iterable[str] = ()) -> int:
+        """Remove directories left by a previous process; returns how many were removed.
+
+        Everything in the manifest belongs to a process that is gone, and
+        anything else under root was never tracked at all. Paths in keep,
+        such as partial downloads about to be resumed, are adopted instead.
+        """
+        keep = set(keep)
+        orphans = {row[0] for row in self._db.execute("SELECT path FROM job_dirs")}
+        orphans.update(entry.path for entry in os.scandir(self.root))
+        orphans -= set(self._expiry) | keep
+        for path in orphans:
+            self._delete(path)
+        self._db.execute("DELETE FROM job_dirs")
+        self._db.commit()
+        for path in keep:
+            self.adopt(path)
+        if orphans:
+            logger.info(f"Reclaimed {len(orphans)} orphaned job directories")
+        return len(orphans)
+
+    def create(self, prefix: str = "ytdl_") -> str:
+        """Make and record a new job directory"""
+        self.ensure_free_space()
+        path = tempfile.mkdtemp(prefix=prefix, dir=self.root)
+        now = time.time()
+        self._db.execute("INSERT INTO job_dirs (path, created_at) VALUES (?, ?)", (path, now))
+        self._db.commit()
+        self._track(path, now + self.max_age)
+        return path
+
+    def adopt(self, path: str):
+        """Track an existing job directory as if it had just been created"""
+        os.makedirs(path, exist_ok=True)
+        now = time.time()
+        self._db.execute("INSERT OR REPLACE INTO job_dirs (path, created_at) VALUES (?, ?)", (path, now))
+        self._db.commit()
+        self._track(path, now + self.max_age)
+
+    def remove(self, path: Optional[str]):
+        """Delete a job directory and forget it"""
+        if not path or self._expiry.pop(path, None) is None:
+            return
+        self._delete(path)
+        self._db.execute("DELETE FROM job_dirs WHERE path = ?", (path,))
+        self._db.commit()
+
+    def ensure_free_space(self):
+        """Ask on_low_space to free whatever root's filesystem is short of min_free_bytes"""
+        if not self.min_free_bytes or not self.on_low_space:
+            return
+        short = self.min_free_bytes - shutil.disk_usage(self.root).free
+        if short > 0:
+            freed = self.on_low_space(short)
+            logger.warning(f"Free space is {short} bytes under the threshold; freed {freed} bytes")
+
+    def _track(self, path: str, expires_at: float):
+        self._expiry[path] = expires_at
+        heapq.heappush(self._heap, (expires_at, path))
+        # Only a new earliest expiry changes how long run() should sleep
+        if self._wakeup and self._heap[0][1] == path:
+            self._wakeup.set()
+
+    def _delete(self, path: str):
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Could not remove {path}: {e}")
+
+    def reclaim_expired(self, now: Optional[float] = None) -> int:
+        """Remove directories past their expiry; entries already removed are skipped"""
+        now = time.time() if now is None else now
+        removed = 0
+        while self._heap and self._heap[0][0] <= now:
+            expires_at, path = heapq.heappop(self._heap)
+            if self._expiry.get(path) != expires_at:
+                continue
+            logger.warning(f"Job directory {path} outlived its job; removing it")
+            self.remove(path)
+            removed += 1
+        self.reclaimed += removed
+        return removed
+
+    async def run(self):
+        """Reclaim expired directories as they come due and keep free space above the threshold"""
+        self._wakeup = asyncio.Event()
+        while True:
+            try:
+                self.reclaim_expired()
+                self.ensure_free_space()
+            except Exception as e:
+                logger.error(f"Job directory cleanup error: {e}")
+            delay = self.check_interval
+            if self._heap:
+                delay = min(delay, max(0.0, self._heap[0][0] - time.time()))
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def __len__(self) -> int:
+        return len(self._expiry)
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,46 @@
+import os
+import subprocess
+import sys
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = (
+    "import main\n"
+    "app = main.build_application()\n"
+    "print(main.MAX_FILE_SIZE, app.bot.base_url, app.bot.base_file_url, app.bot.local_mode)\n"
+)
+
+
+def probe_main(tmp_path, **env):
+    """Import main.py in a fresh interpreter with env and report its Bot API settings"""
+    environ = {k: v for k, v in os.environ.items() if not k.startswith("BOT_API_")}
+    environ.update(env, TELEGRAM_BOT_TOKEN="123:abc", PYTHONPATH=REPO)
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE], cwd=tmp_path, env=environ, capture_output=True, text=True, timeout=120
+    )
+    assert result.returncode == 0, result.stderr
+    return result.stdout.split()
+
+
+def test_local_bot_api_server_raises_the_upload_limit(tmp_path):
+    max_size, base_url, base_file_url, local_mode = probe_main(tmp_path, BOT_API_BASE_URL="http://localhost:8081/bot")
+    assert int(max_size) == 2000 * 1024 * 1024
+    assert base_url == "http://localhost:8081/bot123:abc"
+    assert base_file_url == "http://localhost:8081/file/bot123:abc"
+    assert local_mode == "True"
+
+
+def test_remote_mode_keeps_the_cloud_limit(tmp_path):
+    max_size, base_url, _, local_mode = probe_main(
+        tmp_path, BOT_API_BASE_URL="http://localhost:8081/bot", BOT_API_LOCAL_MODE="false"
+    )
+    assert int(max_size) == 50 * 1024 * 1024
+    assert base_url == "http://localhost:8081/bot123:abc"
+    assert local_mode == "False"
+
+
+def test_default_server_is_telegram(tmp_path):
+    max_size, base_url, _, local_mode = probe_main(tmp_path)
+    assert int(max_size) == 50 * 1024 * 1024
+    assert base_url == "https://api.telegram.org/bot123:abc"
+    assert local_mode == "False"
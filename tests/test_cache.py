@@ -0,0 +1,123 @@
+import asyncio
+import os
+
+from cache import FileIdCache, MediaCache, MetadataCache
+
+
+def test_metadata_cache_reads_back_from_disk(tmp_path):
+    async def scenario():
+        path = str(tmp_path / "metadata.sqlite3")
+        cache = MetadataCache(path, memory_entries=1)
+        await cache.put("Youtube:a", {"title": "A"})
+        await cache.put("Youtube:b", {"title": "B"})
+        # "a" fell out of memory, so this read goes to SQLite
+        assert await cache.get("Youtube:a") == {"title": "A"}
+        assert await cache.get("Youtube:missing") is None
+        cache.close()
+
+        reopened = MetadataCache(path)
+        assert await reopened.get("Youtube:b") == {"title": "B"}
+        reopened.close()
+
+    asyncio.run(scenario())
+
+
+def test_metadata_cache_expires_entries(tmp_path):
+    async def scenario():
+        cache = MetadataCache(str(tmp_path / "metadata.sqlite3"), ttl=-1)
+        await cache.put("Youtube:a", {"title": "A"})
+        assert await cache.get("Youtube:a") is None
+        cache.close()
+
+    asyncio.run(scenario())
+
+
+def test_file_id_cache_stores_per_variant_and_invalidates(tmp_path):
+    async def scenario():
+        cache = FileIdCache(str(tmp_path / "file_ids.sqlite3"))
+        await cache.put("Youtube:a", "format_18", "video", "file-18")
+        await cache.put("Youtube:a", "audio_128", "audio", "file-128")
+        assert await cache.get("Youtube:a", "format_18") == ("video", "file-18")
+        await cache.invalidate("Youtube:a", "format_18")
+        assert await cache.get("Youtube:a", "format_18") is None
+        assert await cache.get("Youtube:a", "audio_128") == ("audio", "file-128")
+        assert await cache.get(None, "audio_128") is None
+        cache.close()
+
+    asyncio.run(scenario())
+
+
+def download(cache: MediaCache, name: str, size: int) -> str:
+    """A finished download of size bytes in the cache's incoming directory"""
+    path = os.path.join(cache.incoming_dir, name + ".mp4")
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    return path
+
+
+def cache_files(cache: MediaCache) -> set:
+    return {entry.name for entry in os.scandir(cache.path) if entry.is_file()}
+
+
+def test_media_cache_evicts_least_recently_used_down_to_the_watermark(tmp_path):
+    cache = MediaCache(str(tmp_path), max_bytes=100, low_watermark=0.8)
+    for key in ("a", "b", "c"):
+        cache.release(cache.put(key, download(cache, key, 30)))
+    cache.release(cache.acquire("a"))
+    # 120 bytes is over budget: b and c go, leaving 60 bytes, under the 80 byte watermark
+    cache.release(cache.put("d", download(cache, "d", 30)))
+    assert [cache.contains(key) for key in "abcd"] == [True, False, False, True]
+    assert (cache.total_bytes, cache.evictions, len(cache)) == (60, 2, 2)
+    assert len(cache_files(cache)) == 2
+
+
+def test_media_cache_keeps_pinned_entries_until_released(tmp_path):
+    cache = MediaCache(str(tmp_path), max_bytes=100, low_watermark=0.8)
+    a = cache.put("a", download(cache, "a", 50))
+    b = cache.put("b", download(cache, "b", 40))
+    a_again = cache.acquire("a")
+    cache.release(cache.put("c", download(cache, "c", 30)))
+    # Over budget, but a and b are being uploaded, so only c can go
+    assert not cache.contains("c")
+    assert os.path.exists(a) and os.path.exists(b)
+    cache.release(a)
+    assert cache.contains("a"), "still pinned by the second acquire"
+    cache.release(a_again)
+    cache.release(b)
+    assert cache.total_bytes == 90
+    # Once unpinned they are ordinary entries again; a was used after b was added
+    cache.release(cache.put("d", download(cache, "d", 20)))
+    assert [cache.contains(key) for key in "abd"] == [True, False, True]
+
+
+def test_media_cache_passes_oversized_and_keyless_files_through(tmp_path):
+    cache = MediaCache(str(tmp_path), max_bytes=100, low_watermark=0.8)
+    big = download(cache, "big", 81)
+    assert cache.put("big", big) == big
+    assert os.path.exists(big) and not cache.contains("big")
+    small = download(cache, "small", 10)
+    assert cache.put(None, small) == small
+    assert cache.total_bytes == 0 and len(cache) == 0
+
+
+def test_media_cache_reloads_in_use_order_after_restart(tmp_path):
+    cache = MediaCache(str(tmp_path), max_bytes=100, low_watermark=0.8)
+    paths = {}
+    for key in ("a", "b", "c"):
+        paths[key] = cache.put(key, download(cache, key, 30))
+        cache.release(paths[key])
+    # Last used: b, then a, then c
+    for mtime, key in enumerate("bac"):
+        os.utime(paths[key], (1000 + mtime, 1000 + mtime))
+    # A copy interrupted by the previous process
+    leftover = paths["a"] + ".partial-0123abcd"
+    open(leftover, "wb").close()
+
+    reopened = MediaCache(str(tmp_path), max_bytes=100, low_watermark=0.8)
+    assert not os.path.exists(leftover)
+    assert (len(reopened), reopened.total_bytes) == (3, 90)
+    assert reopened.acquire("c") == paths["c"]
+
+    # A smaller budget on restart evicts the least recently used first
+    smaller = MediaCache(str(tmp_path), max_bytes=75, low_watermark=0.8)
+    assert [smaller.contains(key) for key in "abc"] == [True, False, True]
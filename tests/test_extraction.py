@@ -0,0 +1,84 @@
+import asyncio
+import threading
+
+import pytest
+
+from extraction import ExtractionCancelled, ExtractionPool, ExtractionQueueFull, pooled_ydl
+
+
+def blocking_lookup(release: threading.Event, result="info"):
+    def lookup():
+        release.wait(5)
+        return result
+    return lookup
+
+
+def test_pool_rejects_lookups_beyond_workers_and_queue():
+    async def scenario():
+        pool = ExtractionPool(max_workers=1, max_queue=1, timeout=5)
+        release = threading.Event()
+        running = [asyncio.create_task(pool.run(key, blocking_lookup(release))) for key in ("a", "b")]
+        await asyncio.sleep(0.01)
+        assert pool.outstanding == 2
+        with pytest.raises(ExtractionQueueFull):
+            await pool.run("c", blocking_lookup(release))
+        release.set()
+        assert await asyncio.gather(*running) == ["info", "info"]
+        assert pool.outstanding == 0
+        pool.shutdown()
+
+    asyncio.run(scenario())
+
+
+def test_timed_out_lookup_keeps_its_slot_until_the_worker_returns():
+    async def scenario():
+        pool = ExtractionPool(max_workers=1, max_queue=0, timeout=0.05)
+        release = threading.Event()
+        with pytest.raises(asyncio.TimeoutError):
+            await pool.run("slow", blocking_lookup(release))
+        # The abandoned worker is still busy, so there is no room yet
+        with pytest.raises(ExtractionQueueFull):
+            await pool.run("next", blocking_lookup(release))
+        release.set()
+        await asyncio.sleep(0.05)
+        assert pool.outstanding == 0
+        pool.shutdown()
+
+    asyncio.run(scenario())
+
+
+def test_cancel_aborts_the_matching_lookup():
+    async def scenario():
+        pool = ExtractionPool(max_workers=1, max_queue=1, timeout=5)
+        release = threading.Event()
+        task = asyncio.create_task(pool.run(("chat", 1), blocking_lookup(release)))
+        await asyncio.sleep(0.01)
+        assert not pool.cancel(("chat", 2))
+        assert pool.cancel(("chat", 1))
+        with pytest.raises(ExtractionCancelled):
+            await task
+        release.set()
+        pool.shutdown()
+
+    asyncio.run(scenario())
+
+
+def test_pooled_ydl_applies_and_restores_a_format_override():
+    opts = {"quiet": True}
+    formats = [
+        {"format_id": format_id, "height": height, "ext": "mp4", "vcodec": "avc1", "acodec": "aac",
+         "url": f"https://example.com/{format_id}", "protocol": "https"}
+        for format_id, height in (("18", 360), ("22", 720))
+    ]
+
+    def resolve(ydl):
+        info = {"id": "x", "title": "x", "extractor": "generic", "extractor_key": "Generic",
+                "webpage_url": "https://example.com/x", "formats": [dict(f) for f in formats]}
+        return ydl.process_ie_result(info, download=False)["format_id"]
+
+    with pooled_ydl(opts, format="18") as ydl:
+        assert resolve(ydl) == "18"
+    # The same thread gets the same instance back, with the default selection again
+    with pooled_ydl(opts) as same:
+        assert same is ydl
+        assert resolve(same) == "22"
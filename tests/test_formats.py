@@ -0,0 +1,40 @@
+import yt_dlp
+
+from formats import capped_format_spec, chosen_size
+
+MB = 1024 * 1024
+
+
+def fmt(format_id, height, vcodec, acodec, filesize):
+    return {
+        "format_id": format_id, "height": height, "vcodec": vcodec, "acodec": acodec,
+        "filesize": filesize, "ext": "mp4", "url": "https://example.com", "protocol": "https",
+    }
+
+
+def select(spec, formats):
+    selector = yt_dlp.YoutubeDL({"quiet": True}).build_format_selector(spec)
+    ctx = {"formats": formats, "has_merged_format": True, "incomplete_formats": False}
+    return [f["format_id"] for f in selector(ctx)]
+
+
+def test_capped_spec_skips_formats_over_the_limit():
+    formats = [
+        fmt("audio", None, "none", "aac", 5 * MB),
+        fmt("360p", 360, "avc1", "aac", 20 * MB),
+        fmt("480p", 480, "avc1", "none", 30 * MB),
+        fmt("720p", 720, "avc1", "none", 200 * MB),
+    ]
+    assert select(capped_format_spec(720, 50 * MB), formats) == ["480p+audio"]
+
+
+def test_capped_spec_still_selects_when_nothing_fits():
+    # Left for max_filesize to refuse, so the item is reported as too large
+    assert select(capped_format_spec(720, 50 * MB), [fmt("720p", 720, "avc1", "aac", 900 * MB)]) == ["720p"]
+
+
+def test_chosen_size_adds_merged_formats():
+    info = {"requested_formats": [{"filesize": 40 * MB}, {"filesize_approx": 10 * MB}]}
+    assert chosen_size(info) > 50 * MB
+    assert chosen_size({"filesize": 7}) == 7
+    assert chosen_size({"requested_formats": [{"filesize": 1}, {}]}) is None
@@ -0,0 +1,96 @@
+import asyncio
+
+import health
+from health import WebhookServer
+
+
+async def exchange(server, request: bytes) -> bytes:
+    """Send raw bytes to a started server and read until it hangs up"""
+    reader, writer = await asyncio.open_connection("127.0.0.1", server._server.sockets[0].getsockname()[1])
+    writer.write(request)
+    await writer.drain()
+    response = await asyncio.wait_for(reader.read(), 5)
+    writer.close()
+    return response
+
+
+def post(body: bytes, token: str, version: str = "HTTP/1.1") -> bytes:
+    return (
+        f"POST /hook {version}\r\n"
+        f"X-Telegram-Bot-Api-Secret-Token: {token}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n\r\n"
+    ).encode() + body
+
+
+def serve(scenario):
+    async def main():
+        updates = []
+
+        async def on_update(update):
+            updates.append(update)
+
+        server = WebhookServer("/hook", on_update, secret_token="s3cret", host="127.0.0.1", port=0)
+        await server.start()
+        try:
+            return await scenario(server), updates
+        finally:
+            await server.stop()
+
+    return asyncio.run(main())
+
+
+def test_webhook_forwards_body_with_matching_secret():
+    response, updates = serve(lambda server: exchange(server, post(b'{"update_id": 7}', "s3cret")))
+    assert response.startswith(b"HTTP/1.1 200 ")
+    assert updates == [{"update_id": 7}]
+
+
+def test_webhook_rejects_wrong_or_missing_secret():
+    async def scenario(server):
+        return [
+            await exchange(server, post(b'{"update_id": 1}', "wrong")),
+            await exchange(server, post(b'{"update_id": 2}', "")),
+        ]
+
+    responses, updates = serve(scenario)
+    assert all(r.startswith(b"HTTP/1.1 403 ") for r in responses)
+    assert updates == []
+
+
+def test_http10_connection_closes_unless_kept_alive():
+    async def scenario(server):
+        # Without the Connection header an HTTP/1.0 client expects the server to hang up
+        closed = await exchange(server, b"GET /livez HTTP/1.0\r\n\r\n")
+        # With keep-alive the connection stays open for a second request
+        reader, writer = await asyncio.open_connection("127.0.0.1", server._server.sockets[0].getsockname()[1])
+        writer.write(b"GET /livez HTTP/1.0\r\nConnection: keep-alive\r\n\r\n")
+        await writer.drain()
+        first = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+        writer.write(b"GET /livez HTTP/1.0\r\n\r\n")
+        await writer.drain()
+        rest = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+        return closed, first, rest
+
+    (closed, first, rest), _ = serve(scenario)
+    assert b"Connection: close" in closed
+    assert b"Connection: keep-alive" in first
+    assert rest.count(b"HTTP/1.1 ") == 1 and b"Connection: close" in rest
+
+
+def test_readiness_fails_once_every_download_slot_is_busy(monkeypatch):
+    max_concurrent = 3
+    monkeypatch.setattr(health, "readiness_max", {})
+    monkeypatch.setattr(health, "readiness_min", {})
+    monkeypatch.setattr(health, "_last_heartbeat", None)
+    monkeypatch.setattr(health, "_load", {})
+    health.configure_probes(30.0, {"active_downloads": max_concurrent - 1}, {})
+
+    health.heartbeat({"active_downloads": max_concurrent - 1})
+    ready, details = health.check_readiness()
+    assert ready and details["failing"] == []
+
+    health.heartbeat({"active_downloads": max_concurrent})
+    ready, details = health.check_readiness()
+    assert not ready and details["failing"] == ["active_downloads"]
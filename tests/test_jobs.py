@@ -0,0 +1,141 @@
+import asyncio
+import threading
+
+from jobs import DownloadScheduler
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def run_postprocessor(key: str, seconds: float = 0.0):
+    """Pass one post-processor through a scheduler's gate, as a download's hooks would, and return the gate"""
+    async def scenario():
+        scheduler = DownloadScheduler(max_downloads=1, max_postprocess=1)
+        async with scheduler.slot("user"):
+            gate = scheduler.new_postprocess_gate()
+            gate({"status": "started", "postprocessor": key})
+            await asyncio.sleep(seconds)
+            gate({"status": "finished", "postprocessor": key})
+        scheduler.shutdown()
+        return gate
+
+    return run(scenario())
+
+
+def test_gate_takes_a_postprocess_slot_for_ffmpeg_pp_keys():
+    async def scenario():
+        scheduler = DownloadScheduler(max_downloads=1, max_postprocess=1)
+        async with scheduler.slot("user"):
+            gate = scheduler.new_postprocess_gate()
+            # The names yt-dlp passes to postprocessor hooks (pp_key(), without the FFmpeg prefix)
+            for key in ("Merger", "ExtractAudio", "FixupM4a"):
+                gate({"status": "started", "postprocessor": key})
+                assert gate.held == 1
+                assert scheduler.stats()["active_postprocessing"] == 1
+                gate({"status": "finished", "postprocessor": key})
+                assert gate.held == 0
+            assert set(gate.elapsed) == {"Merger", "ExtractAudio", "FixupM4a"}
+        scheduler.shutdown()
+
+    run(scenario())
+
+
+def test_gate_ignores_postprocessors_without_ffmpeg():
+    async def scenario():
+        scheduler = DownloadScheduler(max_downloads=1, max_postprocess=1)
+        async with scheduler.slot("user"):
+            gate = scheduler.new_postprocess_gate()
+            gate({"status": "started", "postprocessor": "MoveFiles"})
+            assert gate.held == 0
+            assert scheduler.stats()["active_postprocessing"] == 0
+        scheduler.shutdown()
+
+    run(scenario())
+
+
+def test_users_take_turns_in_the_queue():
+    async def scenario():
+        scheduler = DownloadScheduler(max_downloads=1, max_postprocess=1)
+        order = []
+
+        async def job(user, n):
+            async with scheduler.slot(user):
+                order.append((user, n))
+                await asyncio.sleep(0)
+
+        tasks = [asyncio.create_task(job(user, n)) for user, n in ((1, 0), (1, 1), (1, 2), (2, 0), (3, 0))]
+        await asyncio.gather(*tasks)
+        scheduler.shutdown()
+        return order
+
+    assert run(scenario()) == [(1, 0), (2, 0), (3, 0), (1, 1), (1, 2)]
+
+
+def test_returning_user_queues_behind_waiting_users():
+    async def scenario():
+        scheduler = DownloadScheduler(max_downloads=1, max_postprocess=1)
+        order = []
+        release = asyncio.Event()
+
+        async def job(user, n, hold=False):
+            async with scheduler.slot(user):
+                order.append((user, n))
+                if hold:
+                    await release.wait()
+
+        first = asyncio.create_task(job(1, 0, hold=True))
+        await asyncio.sleep(0)
+        waiting = [asyncio.create_task(job(2, 0)), asyncio.create_task(job(3, 0))]
+        await asyncio.sleep(0)
+        # User 1 asks again while their first job still runs
+        again = asyncio.create_task(job(1, 1))
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(first, again, *waiting)
+        scheduler.shutdown()
+        return order
+
+    assert run(scenario()) == [(1, 0), (2, 0), (3, 0), (1, 1)]
+
+
+def test_ffmpeg_start_hands_the_download_slot_to_the_next_job():
+    async def scenario():
+        scheduler = DownloadScheduler(max_downloads=1, max_postprocess=1)
+        loop = asyncio.get_running_loop()
+        b_started = asyncio.Event()
+        b_in_ffmpeg = threading.Event()
+
+        async def job_a():
+            async with scheduler.slot("a"):
+                gate = scheduler.new_postprocess_gate()
+                # Hooks run on the download thread, like yt-dlp's
+                await loop.run_in_executor(scheduler.executor, gate, {"status": "started", "postprocessor": "Merger"})
+                # B gets the download slot while A is still in ffmpeg
+                await asyncio.wait_for(b_started.wait(), 1)
+                await asyncio.sleep(0.05)
+                assert not b_in_ffmpeg.is_set()
+                await loop.run_in_executor(scheduler.executor, gate, {"status": "finished", "postprocessor": "Merger"})
+
+        async def job_b():
+            async with scheduler.slot("b"):
+                b_started.set()
+                gate = scheduler.new_postprocess_gate()
+
+                def postprocess():
+                    # Waits for A's post-processing slot
+                    gate({"status": "started", "postprocessor": "ExtractAudio"})
+                    b_in_ffmpeg.set()
+                    gate({"status": "finished", "postprocessor": "ExtractAudio"})
+
+                await loop.run_in_executor(scheduler.executor, postprocess)
+
+        a = asyncio.create_task(job_a())
+        await asyncio.sleep(0)
+        b = asyncio.create_task(job_b())
+        await asyncio.gather(a, b)
+        assert b_in_ffmpeg.is_set()
+        assert scheduler.stats()["active_downloads"] == 0
+        scheduler.shutdown()
+
+    run(scenario())
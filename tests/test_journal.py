@@ -0,0 +1,29 @@
+from journal import JobJournal
+
+
+def test_queued_jobs_survive_a_restart_without_a_directory(tmp_path):
+    journal = JobJournal(str(tmp_path / "jobs.sqlite3"))
+    queued = journal.add("https://youtu.be/a", "format_18", "Youtube:a", 1, 10, False, 7)
+    started = journal.add("https://youtu.be/b", "audio_192", "Youtube:b", 2, 20, True, 8)
+    journal.set_temp_dir(started, "/tmp/ytdl_b")
+    finished = journal.add("https://youtu.be/c", "format_22", "Youtube:c", 3, 30, False, 9)
+    journal.remove(finished)
+    journal.close()
+
+    journal = JobJournal(str(tmp_path / "jobs.sqlite3"))
+    resume, dropped = journal.take_interrupted(max_attempts=3)
+    assert dropped == []
+    assert [(job.job_id, job.temp_dir, job.use_caption, job.attempts) for job in resume] == [
+        (queued, "", False, 1),
+        (started, "/tmp/ytdl_b", True, 1),
+    ]
+
+
+def test_jobs_are_given_up_after_max_attempts(tmp_path):
+    journal = JobJournal(str(tmp_path / "jobs.sqlite3"))
+    job_id = journal.add("https://youtu.be/a", "format_18", "Youtube:a", 1, 10, False, 7)
+    assert len(journal.take_interrupted(max_attempts=2)[0]) == 1
+    assert len(journal.take_interrupted(max_attempts=2)[0]) == 1
+    resume, dropped = journal.take_interrupted(max_attempts=2)
+    assert resume == [] and [job.job_id for job in dropped] == [job_id]
+    assert journal.take_interrupted(max_attempts=2) == ([], [])
@@ -0,0 +1,45 @@
+from metrics import ACTIVE_JOBS, ERRORS, render
+from test_jobs import run_postprocessor
+
+
+def sample(series: str) -> float:
+    """Value of the rendered sample with exactly this name and label set, or 0 when absent"""
+    for line in render().splitlines():
+        name, _, value = line.rpartition(" ")
+        if name == series:
+            return float(value)
+    return 0.0
+
+
+def test_render_describes_every_metric():
+    text = render()
+    assert "# HELP ytbot_errors_total Failed requests by error type\n# TYPE ytbot_errors_total counter\n" in text
+    assert "# TYPE ytbot_active_jobs gauge\n" in text
+    assert "# TYPE ytbot_postprocess_seconds histogram\n" in text
+    assert text.endswith("\n")
+
+
+def test_counter_adds_up_per_label_set_with_escaped_values():
+    series = 'ytbot_errors_total{type="Say \\"hi\\""}'
+    before = sample(series)
+    ERRORS.inc(type='Say "hi"')
+    ERRORS.inc(2, type='Say "hi"')
+    assert sample(series) == before + 3
+
+
+def test_gauge_keeps_the_last_value_per_label_set():
+    ACTIVE_JOBS.set(4, stage="download")
+    ACTIVE_JOBS.set(1, stage="postprocess")
+    ACTIVE_JOBS.set(2, stage="download")
+    assert sample('ytbot_active_jobs{stage="download"}') == 2
+    assert sample('ytbot_active_jobs{stage="postprocess"}') == 1
+
+
+def test_postprocess_histogram_renders_cumulative_buckets():
+    labels = 'postprocessor="Merger"'
+    count = sample(f"ytbot_postprocess_seconds_count{{{labels}}}")
+    run_postprocessor("Merger")
+    assert sample(f"ytbot_postprocess_seconds_count{{{labels}}}") == count + 1
+    assert sample(f'ytbot_postprocess_seconds_bucket{{{labels},le="+Inf"}}') == count + 1
+    assert sample(f'ytbot_postprocess_seconds_bucket{{{labels},le="600.0"}}') == count + 1
+    assert sample(f"ytbot_postprocess_seconds_sum{{{labels}}}") >= 0
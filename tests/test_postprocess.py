@@ -0,0 +1,27 @@
+import pytest
+
+from postprocess import AudioEncodeCost
+from test_jobs import run_postprocessor
+from test_metrics import sample
+
+
+def test_gate_times_extract_audio_under_its_pp_key():
+    # main.py feeds this entry to AudioEncodeCost.record
+    assert run_postprocessor("ExtractAudio", seconds=0.01).elapsed.get("ExtractAudio", 0.0) >= 0.01
+
+
+def test_transcodes_refine_the_estimate():
+    cost = AudioEncodeCost(0.02, smoothing=0.5)
+    transcodes = sample('ytbot_audio_jobs_total{mode="transcode"}')
+    assert cost.record(False, ffmpeg_seconds=6.0, duration=100) == 0.0
+    assert cost.seconds_per_audio_second == pytest.approx(0.04)
+    assert sample('ytbot_audio_jobs_total{mode="transcode"}') == transcodes + 1
+
+
+def test_copied_audio_counts_the_encoding_it_avoided():
+    cost = AudioEncodeCost(0.04)
+    copies = sample('ytbot_audio_jobs_total{mode="copy"}')
+    saved = sample("ytbot_audio_cpu_seconds_saved_total")
+    assert cost.record(True, ffmpeg_seconds=1.0, duration=100) == pytest.approx(3.0)
+    assert sample('ytbot_audio_jobs_total{mode="copy"}') == copies + 1
+    assert sample("ytbot_audio_cpu_seconds_saved_total") == pytest.approx(saved + 3.0)
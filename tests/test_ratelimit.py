@@ -0,0 +1,174 @@
+import asyncio
+import hashlib
+import threading
+
+import pytest
+
+from ratelimit import TAKE_SCRIPT, RedisBackend, RedisClient, RedisError, SQLiteBackend, consume
+
+
+def test_consume_starts_full_and_refills():
+    allowed, retry_after, tokens = consume(None, None, 100.0, 3, capacity=10, rate=1)
+    assert (allowed, retry_after, tokens) == (True, 0.0, 7)
+
+    # Two seconds later two tokens are back, but never more than capacity
+    allowed, _, tokens = consume(7, 100.0, 102.0, 3, capacity=10, rate=1)
+    assert allowed and tokens == 6
+    _, _, tokens = consume(9, 100.0, 200.0, 0, capacity=10, rate=1)
+    assert tokens == 10
+
+
+def test_consume_reports_wait_when_empty():
+    allowed, retry_after, tokens = consume(1, 100.0, 100.0, 3, capacity=10, rate=0.5)
+    assert not allowed
+    assert retry_after == pytest.approx(4.0)
+    assert tokens == 1
+
+
+class StandInRedis:
+    """Just enough of a Redis server to exercise RedisClient"""
+
+    def __init__(self):
+        self.scripts = {}
+        self.hashes = {}
+        self.commands = []
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                header = await reader.readline()
+                if not header:
+                    break
+                args = []
+                for _ in range(int(header[1:])):
+                    length = int((await reader.readline())[1:])
+                    args.append((await reader.readexactly(length + 2))[:-2].decode())
+                self.commands.append(args)
+                writer.write(self.reply(args))
+                await writer.drain()
+        finally:
+            writer.close()
+
+    def reply(self, args) -> bytes:
+        name = args[0].upper()
+        if name == "PING":
+            return b"+PONG\r\n"
+        if name == "EVALSHA":
+            if args[1] not in self.scripts:
+                return b"-NOSCRIPT No matching script. Please use EVAL.\r\n"
+            return b"*2\r\n:1\r\n$1\r\n0\r\n"
+        if name == "EVAL":
+            self.scripts[hashlib.sha1(args[1].encode()).hexdigest()] = args[1]
+            return b"*2\r\n:1\r\n$1\r\n0\r\n"
+        if name == "HINCRBY":
+            fields = self.hashes.setdefault(args[1], {})
+            fields[args[2]] = str(int(fields.get(args[2], 0)) + int(args[3]))
+            return b":%d\r\n" % int(fields[args[2]])
+        if name == "HSET":
+            self.hashes.setdefault(args[1], {})[args[2]] = args[3]
+            return b":1\r\n"
+        if name == "HMGET":
+            fields = self.hashes.get(args[1], {})
+            out = [b"*%d\r\n" % (len(args) - 2)]
+            for field in args[2:]:
+                value = fields.get(field)
+                out.append(b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value.encode()))
+            return b"".join(out)
+        return b"-ERR unknown command '%s'\r\n" % name.encode()
+
+
+def with_server(scenario):
+    async def main():
+        stand_in = StandInRedis()
+        server = await asyncio.start_server(stand_in.handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            await scenario(stand_in, f"redis://127.0.0.1:{port}/0")
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    asyncio.run(main())
+
+
+def test_pipeline_returns_replies_in_order():
+    async def scenario(stand_in, url):
+        client = RedisClient(url)
+        assert await client.pipeline(("PING",), ("HSET", "h", "f", "v"), ("HMGET", "h", "f", "g")) == [
+            "PONG", 1, [b"v", None]
+        ]
+        await client.close()
+
+    with_server(scenario)
+
+
+def test_error_reply_raises_and_keeps_the_connection_usable():
+    async def scenario(stand_in, url):
+        client = RedisClient(url)
+        with pytest.raises(RedisError, match="unknown command"):
+            await client.pipeline(("PING",), ("BOGUS",), ("PING",))
+        # All three replies were read, so the next command gets its own reply
+        assert await client.execute("PING") == "PONG"
+        await client.close()
+
+    with_server(scenario)
+
+
+def test_eval_script_loads_the_script_on_noscript():
+    async def scenario(stand_in, url):
+        client = RedisClient(url)
+        assert await client.eval_script(TAKE_SCRIPT, ["k"], [10, 1, 1]) == [1, b"0"]
+        assert [c[0] for c in stand_in.commands] == ["EVALSHA", "EVAL"]
+        # Now cached on the server, so only EVALSHA is sent
+        await client.eval_script(TAKE_SCRIPT, ["k"], [10, 1, 1])
+        assert [c[0] for c in stand_in.commands] == ["EVALSHA", "EVAL", "EVALSHA"]
+        await client.close()
+
+    with_server(scenario)
+
+
+def test_eval_script_raises_other_errors():
+    async def scenario(stand_in, url):
+        client = RedisClient(url)
+        stand_in.reply = lambda args: b"-ERR Error running script\r\n"
+        with pytest.raises(RedisError, match="Error running script"):
+            await client.eval_script(TAKE_SCRIPT, ["k"], [10, 1, 1])
+        assert len(stand_in.commands) == 1
+        await client.close()
+
+    with_server(scenario)
+
+
+def test_redis_backend_stats_round_trip():
+    async def scenario(stand_in, url):
+        backend = RedisBackend(url)
+        await backend.add_stats({7: (2, 1700000000.5)})
+        await backend.add_stats({7: (1, 1700000001.5)})
+        assert await backend.get_stats(7) == (3, 1700000001.5)
+        assert await backend.get_stats(8) == (0, None)
+        await backend.close()
+
+    with_server(scenario)
+
+
+def test_sqlite_backend_runs_off_the_event_loop(tmp_path):
+    async def scenario():
+        backend = SQLiteBackend(str(tmp_path / "limits.sqlite3"))
+        threads = set()
+        take = backend._take
+
+        def recording_take(*args):
+            threads.add(threading.get_ident())
+            return take(*args)
+
+        backend._take = recording_take
+        assert await backend.take("user", 3, 5, 1) == (True, 0.0)
+        allowed, retry_after = await backend.take("user", 3, 5, 1)
+        assert not allowed and retry_after > 0
+        assert threading.get_ident() not in threads
+
+        await backend.add_stats({1: (2, 100.0)})
+        assert await backend.get_stats(1) == (2, 100.0)
+        await backend.close()
+
+    asyncio.run(scenario())
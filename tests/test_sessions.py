@@ -0,0 +1,40 @@
+import time
+
+import pytest
+
+from sessions import BoundedStore
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_entries_expire_after_their_ttl(clock):
+    store = BoundedStore(ttl=60, max_entries=10)
+    store.set("a", 1)
+    clock[0] += 30
+    store.set("b", 2)
+    clock[0] += 30
+    assert store.get("a") == 1
+    clock[0] += 1
+    assert store.get("a", "gone") == "gone"
+    assert store.get("b") == 2
+    # Writing prunes whatever expired meanwhile
+    clock[0] += 60
+    store.set("c", 3)
+    assert len(store) == 1
+
+
+def test_oldest_write_is_evicted_when_full(clock):
+    store = BoundedStore(ttl=60, max_entries=2)
+    store.set("a", 1)
+    store.set("b", 2)
+    # Rewriting a key makes it the newest
+    store.set("a", 10)
+    store.set("c", 3)
+    assert len(store) == 2
+    assert store.get("b") is None
+    assert (store.get("a"), store.get("c")) == (10, 3)
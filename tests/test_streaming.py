@@ -0,0 +1,107 @@
+import asyncio
+
+import httpx
+import pytest
+
+from streaming import StreamError, ranged_chunks, source_size, stream_upload
+
+
+async def chunks(*parts: bytes):
+    for part in parts:
+        yield part
+
+
+def upload(parts, size, reply=None):
+    """Run stream_upload against a fake Bot API and return (result, request body, progress calls)"""
+    received = {}
+    progress = []
+
+    async def handler(request: httpx.Request):
+        received["headers"] = request.headers
+        received["body"] = await request.aread()
+        return httpx.Response(200, json=reply or {"ok": True, "result": {"message_id": 1}})
+
+    async def scenario():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await stream_upload(
+                client,
+                "https://api.telegram.org/bot1:x/sendVideo",
+                {"chat_id": 42, "caption": "clip", "duration": None},
+                "video",
+                "clip.mp4",
+                "video/mp4",
+                chunks(*parts),
+                size,
+                on_progress=lambda sent, total: progress.append((sent, total)),
+                buffer_chunks=1,
+            )
+
+    result = asyncio.run(scenario())
+    return result, received, progress
+
+
+def test_upload_sends_fields_then_the_streamed_file():
+    result, received, progress = upload([b"abc", b"defg"], 7)
+    assert result == {"message_id": 1}
+    boundary = received["headers"]["content-type"].split("boundary=")[1]
+    body = received["body"]
+    assert int(received["headers"]["content-length"]) == len(body)
+    assert body == (
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="chat_id"\r\n\r\n42\r\n'
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="caption"\r\n\r\nclip\r\n'
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="video"; filename="clip.mp4"\r\n'
+        "Content-Type: video/mp4\r\n\r\n"
+        "abcdefg\r\n"
+        f"--{boundary}--\r\n"
+    ).encode()
+    assert progress == [(3, 7), (7, 7)]
+
+
+@pytest.mark.parametrize("parts", [[b"abc", b"defg"], [b"abc"]])
+def test_upload_aborts_when_the_source_size_is_wrong(parts):
+    with pytest.raises(StreamError):
+        upload(parts, 5)
+
+
+def test_upload_rejected_by_telegram_raises():
+    with pytest.raises(StreamError, match="file is too big"):
+        upload([b"abc"], 3, reply={"ok": False, "description": "Bad Request: file is too big"})
+
+
+def test_source_ignoring_ranges_triggers_the_fallback():
+    data = b"x" * 10
+
+    def handler(request: httpx.Request):
+        # A server that always answers 200 with the whole file
+        return httpx.Response(200, content=data)
+
+    async def scenario():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            size = await source_size(client, "https://cdn.example/v.mp4", {})
+            return size, [chunk async for chunk in ranged_chunks(client, "https://cdn.example/v.mp4", {}, size, 4)]
+
+    with pytest.raises(StreamError, match="ignores Range"):
+        asyncio.run(scenario())
+
+
+def test_ranged_source_is_read_in_pieces():
+    data = bytes(range(10))
+    ranges = []
+
+    def handler(request: httpx.Request):
+        start, end = map(int, request.headers["range"].split("=")[1].split("-"))
+        ranges.append((start, end))
+        return httpx.Response(
+            206, content=data[start:end + 1], headers={"Content-Range": f"bytes {start}-{end}/{len(data)}"}
+        )
+
+    async def scenario():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            size = await source_size(client, "https://cdn.example/v.mp4", {})
+            return size, b"".join([chunk async for chunk in ranged_chunks(client, "https://cdn.example/v.mp4", {}, size, 4)])
+
+    assert asyncio.run(scenario()) == (10, data)
+    assert ranges == [(0, 0), (0, 3), (4, 7), (8, 9)]
@@ -0,0 +1,78 @@
+import os
+import time
+
+import pytest
+
+from tempdirs import JobDirs
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    return now
+
+
+def job_dirs(tmp_path, **kwargs) -> JobDirs:
+    return JobDirs(str(tmp_path / "jobs"), str(tmp_path / "state" / "job_dirs.sqlite3"), **kwargs)
+
+
+def test_expired_directories_are_reclaimed_in_expiry_order(tmp_path, clock):
+    dirs = job_dirs(tmp_path, max_age=100)
+    a = dirs.create()
+    clock[0] += 10
+    b = dirs.create()
+    clock[0] += 10
+    # Adopting a again pushes its expiry past b's; its first heap entry goes stale
+    dirs.adopt(a)
+
+    assert dirs.reclaim_expired(1105) == 0
+    assert os.path.isdir(a)
+    assert dirs.reclaim_expired(1115) == 1
+    assert not os.path.exists(b) and os.path.isdir(a)
+    dirs.remove(a)
+    assert dirs.reclaim_expired(2000) == 0
+    assert (len(dirs), dirs.reclaimed) == (0, 1)
+    dirs.close()
+
+
+def test_orphans_are_removed_except_those_kept(tmp_path):
+    previous = job_dirs(tmp_path)
+    done, resumable, killed = previous.create(), previous.create(), previous.create()
+    previous.remove(done)
+    with open(os.path.join(killed, "video.part"), "wb") as f:
+        f.write(b"partial")
+    previous.close()
+    # Never recorded in the manifest, but still under root
+    stray = os.path.join(previous.root, "stray.mp4")
+    open(stray, "wb").close()
+
+    dirs = job_dirs(tmp_path)
+    assert dirs.reclaim_orphans(keep=[resumable]) == 2
+    assert not os.path.exists(killed) and not os.path.exists(stray)
+    assert os.path.isdir(resumable) and len(dirs) == 1
+    dirs.close()
+
+    # The kept directory was re-recorded, so it is an orphan if that process dies too
+    after = job_dirs(tmp_path)
+    assert after.reclaim_orphans() == 1
+    assert os.listdir(after.root) == []
+    after.close()
+
+
+def test_remove_deletes_trees_but_not_what_links_point_to(tmp_path):
+    dirs = job_dirs(tmp_path)
+    path = dirs.create()
+    os.makedirs(os.path.join(path, "nested", "deeper"))
+    open(os.path.join(path, "nested", "deeper", "f"), "wb").close()
+    dirs.remove(path)
+    assert not os.path.exists(path)
+
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    (outside / "keep.txt").write_text("mine")
+    os.symlink(outside, os.path.join(dirs.root, "link"))
+    assert dirs.reclaim_orphans() == 1
+    assert not os.path.lexists(os.path.join(dirs.root, "link"))
+    assert (outside / "keep.txt").read_text() == "mine"
+    dirs.close()